@@ -0,0 +1,167 @@
+import os
+import json
+import math
+import logging
+import numpy as np
+from sim_context import kmeans, nearest_centroids
+
+try:
+    import hnswlib
+except ImportError:
+    hnswlib = None
+
+ANN_INDEXES = ["ivf", "hnsw"]
+ANN_META_FILE = "ann.json"
+IVF_FILE = "ivf.npz"
+HNSW_FILE = "hnsw.bin"
+
+def top_k(scores, k):
+    # argpartition finds the k best rows in linear time; only those k are then sorted
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    best = np.argpartition(-scores, k - 1)[:k]
+    return best[np.argsort(-scores[best])]
+
+def write_meta(path, meta):
+    tmp = os.path.join(path, ANN_META_FILE + ".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(meta, f)
+    os.replace(tmp, os.path.join(path, ANN_META_FILE))
+
+def read_meta(path):
+    # Kind, settings and store version of the index saved next to a local store, or None
+    meta_path = os.path.join(path, ANN_META_FILE)
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path, encoding="utf-8") as f:
+        return json.load(f)
+
+def load_index(path, store_version):
+    # Returns the index saved next to a local store, or None when there is none or it was built for
+    # an older version of the store (the store is exported again, the index has to be rebuilt)
+    meta = read_meta(path)
+    if meta is None:
+        return None
+    if meta.get("store_version") != store_version:
+        logging.warning(f"The {meta.get('kind')} index in {path} is older than the vector store; using exact search until it is rebuilt.")
+        return None
+    return {"ivf": IVFIndex, "hnsw": HNSWIndex}[meta["kind"]].load(path, meta)
+
+
+# Inverted file index: rows are bucketed under their nearest k-means centroid and a query scans only
+# the `nprobe` buckets whose centroids score highest. More buckets probed means higher recall and
+# slower queries. Deleted rows stay in their bucket; the store filters them out of the candidates.
+class IVFIndex:
+    kind = "ivf"
+
+    def __init__(self, centroids, lists, nprobe=8):
+        self.centroids = centroids
+        self.lists = lists
+        self.nprobe = nprobe
+
+    @classmethod
+    def build(cls, matrix, nlist=None, nprobe=8, train_size=None):
+        nlist = min(len(matrix), nlist or max(1, int(4 * math.sqrt(len(matrix)))))
+        # Training on a sample keeps the k-means cost independent of the corpus size
+        train_size = min(len(matrix), train_size or max(32 * nlist, 10000))
+        sample = np.sort(np.random.default_rng(0).choice(len(matrix), train_size, replace=False))
+        centroids, _ = kmeans(np.asarray(matrix[sample], dtype=np.float32), nlist)
+        centroids = centroids.astype(np.float32)
+        assignments = nearest_centroids(matrix, centroids)
+        order = np.argsort(assignments, kind="stable")
+        lists = np.split(order, np.cumsum(np.bincount(assignments, minlength=nlist))[:-1])
+        return cls(centroids, lists, nprobe)
+
+    def add(self, rows, vectors):
+        assignments = nearest_centroids(vectors, self.centroids)
+        for bucket in np.unique(assignments):
+            self.lists[bucket] = np.concatenate([self.lists[bucket], rows[assignments == bucket]])
+
+    def delete(self, rows):
+        pass
+
+    def search(self, query, k):
+        probed = top_k(self.centroids @ query, self.nprobe)
+        return np.concatenate([self.lists[bucket] for bucket in probed])
+
+    def tune(self, nprobe=None, ef=None):
+        if nprobe:
+            self.nprobe = nprobe
+
+    def save(self, path, store_version):
+        tmp = os.path.join(path, IVF_FILE + ".tmp.npz")
+        np.savez(tmp, centroids=self.centroids, rows=np.concatenate(self.lists),
+                 offsets=np.cumsum([0] + [len(rows) for rows in self.lists]))
+        os.replace(tmp, os.path.join(path, IVF_FILE))
+        write_meta(path, {"kind": self.kind, "store_version": store_version, "nlist": len(self.lists), "nprobe": self.nprobe})
+
+    @classmethod
+    def load(cls, path, meta):
+        data = np.load(os.path.join(path, IVF_FILE))
+        rows, offsets = data["rows"], data["offsets"]
+        lists = [rows[offsets[i]:offsets[i + 1]] for i in range(len(offsets) - 1)]
+        return cls(data["centroids"], lists, meta.get("nprobe", 8))
+
+
+# Hierarchical navigable small world graph from hnswlib (optional dependency). `m` and
+# `ef_construction` trade build time and memory for graph quality; `ef` is the query-time beam
+# width, the main recall/latency knob. Deletes are marked in the graph so they are never returned.
+class HNSWIndex:
+    kind = "hnsw"
+
+    def __init__(self, index, ef=64):
+        self.index = index
+        self.ef = ef
+        index.set_ef(ef)
+
+    @classmethod
+    def build(cls, matrix, m=16, ef_construction=200, ef=64, deleted=None, chunk_size=65536):
+        if hnswlib is None:
+            raise ImportError("The hnsw index requires hnswlib: pip install hnswlib")
+        index = hnswlib.Index(space="ip", dim=matrix.shape[1])
+        index.init_index(max_elements=max(1, len(matrix)), M=m, ef_construction=ef_construction)
+        for start in range(0, len(matrix), chunk_size):
+            block = np.asarray(matrix[start:start + chunk_size], dtype=np.float32)
+            index.add_items(block, np.arange(start, start + len(block)))
+        built = cls(index, ef)
+        if deleted is not None:
+            built.delete(np.flatnonzero(deleted))
+        return built
+
+    def add(self, rows, vectors):
+        needed = self.index.get_current_count() + len(rows)
+        if needed > self.index.get_max_elements():
+            self.index.resize_index(max(needed, 2 * self.index.get_max_elements()))
+        self.index.add_items(np.asarray(vectors, dtype=np.float32), rows)
+
+    def delete(self, rows):
+        for row in rows:
+            self.index.mark_deleted(int(row))
+
+    def search(self, query, k):
+        # The beam has to be at least as wide as the number of results asked for
+        self.index.set_ef(max(self.ef, k))
+        labels, _ = self.index.knn_query(query, k=k)
+        return labels[0].astype(np.int64)
+
+    def tune(self, nprobe=None, ef=None):
+        if ef:
+            self.ef = ef
+            self.index.set_ef(ef)
+
+    def save(self, path, store_version):
+        tmp = os.path.join(path, HNSW_FILE + ".tmp")
+        self.index.save_index(tmp)
+        os.replace(tmp, os.path.join(path, HNSW_FILE))
+        write_meta(path, {"kind": self.kind, "store_version": store_version, "dimensions": self.index.dim,
+                          "max_elements": self.index.get_max_elements(), "ef": self.ef,
+                          "m": self.index.M, "ef_construction": self.index.ef_construction})
+
+    @classmethod
+    def load(cls, path, meta):
+        if hnswlib is None:
+            raise ImportError("The hnsw index requires hnswlib: pip install hnswlib")
+        index = hnswlib.Index(space="ip", dim=meta["dimensions"])
+        index.load_index(os.path.join(path, HNSW_FILE), max_elements=meta["max_elements"])
+        return cls(index, meta.get("ef", 64))
@@ -1,13 +1,20 @@
 import os
+import asyncio
+import argparse
+from datetime import datetime, timezone
 from dotenv import load_dotenv
 from pymongo import MongoClient
-from openai import OpenAI
+from sim_store import AnswerWriter
+from sim_llm import LLMClient
 
 # Load environment variables
 load_dotenv()
 
-# Setup OpenAI client
-openai_client = OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
+# Setup OpenAI client: rate limited, retried and optionally cached (see sim_llm.py)
+llm = LLMClient.from_env()
+
+# Marker document in the runs collection, present once older questions have the answered flag
+ANSWERED_BACKFILL = "answered_backfill"
 
 # MongoDB setup
 def connect_to_mongodb():
@@ -16,12 +23,38 @@ def connect_to_mongodb():
     db = mongo_client["simulation"]
     return db["synthdata"]
 
-def fetch_question_by_id(collection, question_id):
-    return collection.find_one({"id": question_id})
+def latest_run_id(collection):
+    # Most recent run of sim_questions.py. Runs created before runs recorded their producer count when
+    # their questions carry the top-level id this script answers by, which sims_start.py questions lack
+    for run in collection.database["runs"].find({"producer": {"$in": ["sim_questions", None]}}, sort=[("created_at", -1)]):
+        if run.get("producer") or collection.find_one({"run_id": run["_id"], "id": {"$exists": True}}, {"_id": 1}):
+            return run["_id"]
+    return None
+
+def ensure_indexes(collection):
+    # Questions written before the answered flag existed are marked once so the partial index covers
+    # them; a marker in the runs collection records that the backfill ran. Lookups by (run_id, id) use
+    # the unique index sim_questions.py creates.
+    runs = collection.database["runs"]
+    if not runs.find_one({"_id": ANSWERED_BACKFILL}):
+        collection.update_many({"id": {"$exists": True}, "answer": {"$exists": False}, "answered": {"$exists": False}},
+                               {"$set": {"answered": False}})
+        runs.update_one({"_id": ANSWERED_BACKFILL}, {"$set": {"done_at": datetime.now(timezone.utc)}}, upsert=True)
+    collection.create_index([("run_id", 1), ("answered", 1), ("id", 1)], name="unanswered_questions",
+                            partialFilterExpression={"answered": False})
+
+def fetch_question_by_id(collection, question_id, run_id=None):
+    return collection.find_one({"run_id": run_id, "id": question_id})
+
+def unanswered_questions(collection, run_id, batch_size, after_id=0):
+    # One short query per batch, paged on id, so no server cursor idles while the workers answer
+    return list(collection.find({"run_id": run_id, "answered": False, "id": {"$gt": after_id}}, {"_id": 0, "id": 1, "question_text": 1})
+                .sort("id", 1)
+                .limit(batch_size))
 
 def generate_detailed_response(question_text):
     try:
-        response = openai_client.chat.completions.create(
+        content, _ = llm.chat(
             model="gpt-3.5-turbo",
             messages=[
                 {"role": "system", "content": "You are a knowledgeable AI tasked with imagining and simulating the most likely future outcomes for the scenario described in the question. Answer the question with a detailed response."},
@@ -29,28 +62,105 @@ def generate_detailed_response(question_text):
             ],
             max_tokens=4096
         )
-        detailed_response = response.choices[0].message.content.strip()
+        detailed_response = content.strip()
         print(f"Generated Response: {detailed_response}")  # Log the response to the console
         return detailed_response
     except Exception as e:
         print(f"Failed to generate response: {e}")
         return ""
 
-def store_answer(collection, question_id, answer):
-    collection.update_one({"id": question_id}, {"$set": {"answer": answer}})
+async def generate_detailed_response_async(question_text):
+    try:
+        content, _ = await llm.achat(
+            model="gpt-3.5-turbo",
+            messages=[
+                {"role": "system", "content": "You are a knowledgeable AI tasked with imagining and simulating the most likely future outcomes for the scenario described in the question. Answer the question with a detailed response."},
+                {"role": "user", "content": "Provide a detailed answer to the following question simulating this scenario in the future: " + question_text}
+            ],
+            max_tokens=4096
+        )
+        detailed_response = content.strip()
+        print(f"Generated Response: {detailed_response}")
+        return detailed_response
+    except Exception as e:
+        print(f"Failed to generate response: {e}")
+        return ""
 
-def main():
-    collection = connect_to_mongodb()
+def store_answer(answer_writer, question_id, answer, run_id=None):
+    answer_writer.add({"run_id": run_id, "id": question_id}, {"$set": {"answer": answer, "answered": True}})
+
+async def answer_unanswered_questions(collection, answer_writer, run_id, concurrency, batch_size):
+    # Projected batches feed a bounded queue; failed answers stay unanswered for the next run
+    queue = asyncio.Queue(maxsize=max(batch_size, concurrency))
+    counts = {"answered": 0, "failed": 0}
+
+    async def produce():
+        last_id = 0
+        try:
+            while True:
+                batch = await asyncio.to_thread(unanswered_questions, collection, run_id, batch_size, last_id)
+                if not batch:
+                    break
+                last_id = batch[-1]["id"]
+                for question in batch:
+                    await queue.put(question)
+        finally:
+            for _ in range(concurrency):
+                await queue.put(None)
+
+    async def consume():
+        while True:
+            question = await queue.get()
+            if question is None:
+                break
+            question_text = question.get('question_text', 'No question text provided')
+            detailed_response = await generate_detailed_response_async(question_text)
+            if not detailed_response:
+                counts["failed"] += 1
+                continue
+            store_answer(answer_writer, question['id'], detailed_response, run_id)
+            counts["answered"] += 1
+            print(f"Queued detailed response for question ID {question['id']}")
+
+    await asyncio.gather(produce(), *(consume() for _ in range(concurrency)))
+    print(f"Answered {counts['answered']} questions, {counts['failed']} failed and remain unanswered")
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Simulation Answer Generator")
+    parser.add_argument("--run-id", help="Run whose questions are answered (defaults to the most recent run)")
+    parser.add_argument("--concurrency", type=int, default=4, help="Answer requests in flight at once")
+    parser.add_argument("--batch-size", type=int, default=100, help="Unanswered questions fetched per query")
+    parser.add_argument("--by-id", action="store_true",
+                        help="Use the old scan that looks questions up one id at a time and stops at the first gap")
+    return parser.parse_args()
+
+def answer_by_id(collection, answer_writer, run_id):
     question_id = 1  # Start with the first question
     while True:
-        question = fetch_question_by_id(collection, question_id)
+        question = fetch_question_by_id(collection, question_id, run_id)
         if not question:
             break  # Break the loop if there are no more questions
         question_text = question.get('question_text', 'No question text provided')  # Use 'question_text' instead of 'question'
         detailed_response = generate_detailed_response(question_text)
-        store_answer(collection, question_id, detailed_response)
-        print(f"Stored detailed response for question ID {question_id}")
+        if detailed_response:
+            store_answer(answer_writer, question_id, detailed_response, run_id)
+            print(f"Queued detailed response for question ID {question_id}")
+        else:
+            print(f"No answer for question ID {question_id}, leaving it unanswered")
         question_id += 1  # Increment to fetch the next question
 
+def main():
+    args = parse_args()
+    collection = connect_to_mongodb()
+    run_id = args.run_id or latest_run_id(collection)
+    print(f"Answering questions for run {run_id}")
+    ensure_indexes(collection)
+    with AnswerWriter(collection) as answer_writer:
+        if args.by_id:
+            answer_by_id(collection, answer_writer, run_id)
+        else:
+            asyncio.run(answer_unanswered_questions(collection, answer_writer, run_id, args.concurrency, args.batch_size))
+    llm.report()
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
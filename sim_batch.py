@@ -0,0 +1,129 @@
+import os
+import csv
+import json
+import time
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+import sims_start
+
+def load_scenarios(path, default_iterations):
+    # Accepts a JSON/YAML list of scenario strings or {"scenario": ..., "iterations": ...} objects,
+    # or a CSV file with a "scenario" column and an optional "iterations" column
+    extension = os.path.splitext(path)[1].lower()
+    with open(path, newline='', encoding='utf-8') as f:
+        if extension == '.csv':
+            entries = list(csv.DictReader(f))
+        elif extension in ('.yaml', '.yml'):
+            try:
+                import yaml
+            except ImportError:
+                raise ImportError("Reading YAML scenario files requires PyYAML: pip install pyyaml")
+            entries = yaml.safe_load(f)
+        else:
+            entries = json.load(f)
+
+    scenarios = []
+    for entry in entries:
+        if isinstance(entry, str):
+            entry = {'scenario': entry}
+        scenario = (entry.get('scenario') or '').strip()
+        if scenario:
+            scenarios.append({'scenario': scenario, 'iterations': int(entry.get('iterations') or default_iterations)})
+    return scenarios
+
+def prepare_runs(collection, batch_id, scenarios):
+    # One run per scenario in the batch; rerunning the same batch id picks up the existing runs
+    runs = sims_start.runs_collection(collection)
+    prepared = []
+    for entry in scenarios:
+        run = runs.find_one({'batch_id': batch_id, 'scenario': entry['scenario']})
+        if run is None:
+            run = sims_start.create_run(collection, entry['scenario'], entry['iterations'], batch_id=batch_id)
+        prepared.append(run)
+    return prepared
+
+def run_scenario(run_id, args, gate, limit_share):
+    sims_start.llm.gate = gate
+    sims_start.llm.set_limit_share(limit_share)
+    collection = sims_start.connect_to_mongodb()
+    run = sims_start.load_run(collection, run_id)
+    started = time.perf_counter()
+    all_questions = sims_start.simulate(collection, run, args)
+    return {
+        'run_id': run_id,
+        'scenario': run['scenario'],
+        'questions': len(all_questions),
+        'seconds': time.perf_counter() - started
+    }
+
+def report_progress(collection, runs, started):
+    run_ids = [run['_id'] for run in runs]
+    progress = list(sims_start.runs_collection(collection).aggregate([
+        {'$match': {'_id': {'$in': run_ids}}},
+        {'$group': {'_id': None, 'done': {'$sum': '$completed_iterations'}, 'total': {'$sum': '$iterations'}}}
+    ]))
+    questions = collection.count_documents({'run_id': {'$in': run_ids}})
+    answered = collection.count_documents({'run_id': {'$in': run_ids}, 'metadata.answer': {'$nin': [None, '']}})
+    elapsed = time.perf_counter() - started
+    done, total = (progress[0]['done'], progress[0]['total']) if progress else (0, 0)
+    print(f"[{elapsed:.0f}s] question sets {done}/{total}, questions {questions}, answered {answered} "
+          f"({answered / elapsed * 60 if elapsed else 0:.1f} answers/min)")
+    return questions, answered
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Run many simulation scenarios in parallel without prompts")
+    parser.add_argument("scenarios_file", help="JSON, YAML or CSV file listing the scenarios to simulate")
+    parser.add_argument("--iterations", type=int, default=5, help="Sets of 10 questions for scenarios that do not set their own")
+    parser.add_argument("--processes", type=int, default=os.cpu_count(), help="Scenarios simulated at the same time")
+    parser.add_argument("--max-in-flight", type=int, default=32, help="Cap on OpenAI requests in flight across all processes")
+    parser.add_argument("--batch-id", help="Rerun an earlier batch, continuing its unfinished scenarios")
+    parser.add_argument("--report-interval", type=float, default=30.0, help="Seconds between progress reports")
+    sims_start.add_simulation_arguments(parser)
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    scenarios = load_scenarios(args.scenarios_file, args.iterations)
+    batch_id = args.batch_id or sims_start.new_run_id()
+    collection = sims_start.connect_to_mongodb()
+    sims_start.ensure_indexes(collection)
+    runs = prepare_runs(collection, batch_id, scenarios)
+    print(f"Batch {batch_id}: {len(runs)} scenarios across {args.processes} processes, "
+          f"at most {args.max_in_flight} OpenAI requests in flight")
+
+    started = time.perf_counter()
+    results = []
+    failures = []
+    # Spawned workers open their own MongoDB and OpenAI connections instead of inheriting the parent's
+    context = multiprocessing.get_context("spawn")
+    with context.Manager() as manager:
+        gate = manager.BoundedSemaphore(args.max_in_flight)
+        with ProcessPoolExecutor(max_workers=args.processes, mp_context=context) as executor:
+            # Every process gets an equal share of the account's requests- and tokens-per-minute limits
+            limit_share = 1.0 / max(1, min(args.processes, len(runs)))
+            pending = {executor.submit(run_scenario, run['_id'], args, gate, limit_share): run for run in runs}
+            while pending:
+                finished, _ = wait(pending, timeout=args.report_interval, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    run = pending.pop(future)
+                    try:
+                        results.append(future.result())
+                        print(f"Finished scenario '{run['scenario']}' (run {run['_id']})")
+                    except Exception as e:
+                        failures.append(run)
+                        print(f"Scenario '{run['scenario']}' (run {run['_id']}) failed: {e}")
+                report_progress(collection, runs, started)
+
+    elapsed = time.perf_counter() - started
+    questions, answered = report_progress(collection, runs, started)
+    print(f"Batch {batch_id} complete in {elapsed:.1f}s: {len(results)} scenarios finished, {len(failures)} failed, "
+          f"{questions / elapsed * 60 if elapsed else 0:.1f} questions/min, {answered / elapsed * 60 if elapsed else 0:.1f} answers/min")
+    for result in sorted(results, key=lambda r: r['seconds'], reverse=True):
+        print(f"  {result['run_id']}: {result['questions']} questions in {result['seconds']:.1f}s - {result['scenario']}")
+    if failures:
+        print(f"Rerun with --batch-id {batch_id} to continue the failed scenarios")
+
+if __name__ == "__main__":
+    main()
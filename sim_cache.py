@@ -0,0 +1,254 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+from sim_sources import source_id_value
+
+CACHE_MODES = ["off", "on", "replay"]
+
+class CacheMiss(Exception):
+    pass
+
+
+# Disk-backed cache of chat completions keyed on a hash of the model, messages and generation
+# parameters. "on" reads through to the API and records new responses; "replay" serves recorded
+# responses only and raises CacheMiss instead of calling the API. Least recently used entries are
+# evicted once the stored responses exceed max_bytes.
+class LLMCache:
+    def __init__(self, path="llm_cache.sqlite", max_bytes=512 * 1024 * 1024, mode="on"):
+        if mode not in CACHE_MODES:
+            raise ValueError(f"Unknown cache mode '{mode}', expected one of {CACHE_MODES}")
+        self.path = path
+        self.max_bytes = max_bytes
+        self.mode = mode
+        self.hits = 0
+        self.misses = 0
+        self.puts_since_eviction = 0
+        self.lock = threading.Lock()
+        # WAL lets the processes of a batch run share one cache file
+        self.connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS responses (
+            key TEXT PRIMARY KEY, model TEXT, content TEXT, prompt_tokens INTEGER,
+            size INTEGER, created_at REAL, last_access REAL)""")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)")
+        self.connection.commit()
+        self.evict()
+
+    @classmethod
+    def from_env(cls, mode=None):
+        # SIM_LLM_CACHE=off|on|replay, SIM_LLM_CACHE_PATH and SIM_LLM_CACHE_MAX_MB configure the cache
+        mode = mode or os.getenv("SIM_LLM_CACHE", "off")
+        if mode == "off":
+            return None
+        path = os.getenv("SIM_LLM_CACHE_PATH", "llm_cache.sqlite")
+        max_bytes = int(float(os.getenv("SIM_LLM_CACHE_MAX_MB", "512")) * 1024 * 1024)
+        return cls(path, max_bytes, mode)
+
+    @staticmethod
+    def key(model, messages, **params):
+        payload = json.dumps({"model": model, "messages": messages, "params": params}, sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            row = self.connection.execute("SELECT content, prompt_tokens FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.connection.execute("UPDATE responses SET last_access = ? WHERE key = ?", (time.time(), key))
+                self.connection.commit()
+        if row is None and self.mode == "replay":
+            raise CacheMiss(f"No recorded response for request {key[:12]} in replay mode")
+        return row
+
+    def put(self, key, model, content, prompt_tokens=None):
+        now = time.time()
+        with self.lock:
+            self.connection.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                    (key, model, content, prompt_tokens, len(content.encode("utf-8")), now, now))
+            self.connection.commit()
+            self.puts_since_eviction += 1
+            due = self.puts_since_eviction >= 100
+        if due:
+            self.evict()
+
+    def evict(self):
+        with self.lock:
+            self.puts_since_eviction = 0
+            total = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+            if total <= self.max_bytes:
+                return
+            # Walk from the least recently used entry until enough bytes have been freed
+            freed, keys = 0, []
+            for key, size in self.connection.execute("SELECT key, size FROM responses ORDER BY last_access"):
+                if total - freed <= self.max_bytes:
+                    break
+                keys.append((key,))
+                freed += size
+            self.connection.executemany("DELETE FROM responses WHERE key = ?", keys)
+            self.connection.commit()
+        print(f"LLM cache evicted {len(keys)} responses ({freed} bytes)")
+
+    def report(self):
+        total = self.hits + self.misses
+        print(f"LLM cache ({self.mode}): {self.hits} hits, {self.misses} misses"
+              + (f", {self.hits / total:.0%} hit rate" if total else ""))
+
+
+# In-memory cache of query engine responses keyed on the query embedding, for questions asked again
+# in different words. get() returns the stored response of the most similar cached query when the
+# cosine similarity reaches `threshold`. Entries expire after `ttl` seconds, the least recently used
+# are dropped beyond `max_entries`, and everything is cleared when `version()` (the vector
+# collection's version, checked at most every `check_interval` seconds) changes.
+class SemanticCache:
+    def __init__(self, threshold=0.95, max_entries=1000, ttl=3600, version=None, check_interval=10):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.version = version
+        self.check_interval = check_interval
+        self.entries = OrderedDict()
+        self.next_key = 0
+        self.matrix, self.keys = None, []
+        self.known_version, self.checked_at = None, 0.0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.seconds_saved = 0.0
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls, version=None):
+        # SIM_QUERY_CACHE=on|off, SIM_QUERY_CACHE_THRESHOLD, SIM_QUERY_CACHE_SIZE and SIM_QUERY_CACHE_TTL configure the cache
+        if os.getenv("SIM_QUERY_CACHE", "on") == "off":
+            return None
+        return cls(threshold=float(os.getenv("SIM_QUERY_CACHE_THRESHOLD", "0.95")),
+                   max_entries=int(os.getenv("SIM_QUERY_CACHE_SIZE", "1000")),
+                   ttl=float(os.getenv("SIM_QUERY_CACHE_TTL", "3600")), version=version)
+
+    def get(self, embedding):
+        # Returns (response, similarity) for a near-match, or None
+        embedding = self._normalize(embedding)
+        with self.lock:
+            self._check_version()
+            self._expire()
+            if self.matrix is None:
+                self._rebuild()
+            best = None
+            if len(self.keys):
+                scores = self.matrix @ embedding
+                i = int(np.argmax(scores))
+                if scores[i] >= self.threshold:
+                    best = self.keys[i], float(scores[i])
+            if best is None:
+                self.misses += 1
+                return None
+            key, similarity = best
+            self.entries.move_to_end(key)
+            _, response, _, latency = self.entries[key]
+            self.hits += 1
+            self.seconds_saved += latency
+            return response, similarity
+
+    def put(self, embedding, response, latency):
+        # `latency` is how long the response took to produce, credited as saved on every hit
+        with self.lock:
+            self.entries[self.next_key] = (self._normalize(embedding), response, time.monotonic(), latency)
+            self.next_key += 1
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+            self.matrix = None
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.matrix = None
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {"entries": len(self.entries), "hits": self.hits, "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0, "seconds_saved": self.seconds_saved,
+                "invalidations": self.invalidations}
+
+    def _normalize(self, embedding):
+        embedding = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(embedding)
+        return embedding / norm if norm else embedding
+
+    def _check_version(self):
+        if self.version is None or time.monotonic() - self.checked_at < self.check_interval:
+            return
+        self.checked_at = time.monotonic()
+        current = self.version()
+        if current != self.known_version:
+            if self.entries:
+                self.invalidations += 1
+            self.entries.clear()
+            self.matrix = None
+            self.known_version = current
+
+    def _expire(self):
+        # Entries are in least recently used order, so the oldest is not necessarily first; scan them all
+        cutoff = time.monotonic() - self.ttl
+        expired = [key for key, entry in self.entries.items() if entry[2] < cutoff]
+        for key in expired:
+            del self.entries[key]
+        if expired:
+            self.matrix = None
+
+    def _rebuild(self):
+        self.keys = list(self.entries)
+        self.matrix = np.stack([self.entries[key][0] for key in self.keys]) if self.keys else None
+
+
+# In-process LRU cache of raw source documents by their _id (as a string), for showing the question
+# and answer behind retrieved chunks. get() serves what it holds from memory and fetches the rest in
+# one $in query projected to the metadata, so stored embeddings are never read back.
+class SourceCache:
+    def __init__(self, collection, max_entries=1000):
+        self.collection = collection
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls, collection):
+        # SIM_SOURCE_CACHE_SIZE source documents are kept
+        return cls(collection, max_entries=int(os.getenv("SIM_SOURCE_CACHE_SIZE", "1000")))
+
+    def get(self, source_ids):
+        # Returns {source_id: metadata} for the ids that exist, in the order given
+        found, missing = {}, []
+        with self.lock:
+            for source_id in dict.fromkeys(source_ids):
+                if source_id in self.entries:
+                    self.entries.move_to_end(source_id)
+                    found[source_id] = self.entries[source_id]
+                    self.hits += 1
+                else:
+                    missing.append(source_id)
+                    self.misses += 1
+        if missing:
+            values = [source_id_value(source_id) for source_id in missing]
+            fetched = {str(doc['_id']): doc.get('metadata') or {} for doc in self.collection.find({'_id': {'$in': values}}, {'metadata': 1})}
+            with self.lock:
+                for source_id, metadata in fetched.items():
+                    self.entries[source_id] = metadata
+                    self.entries.move_to_end(source_id)
+                while len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+            found.update(fetched)
+        return {source_id: found[source_id] for source_id in dict.fromkeys(source_ids) if source_id in found}
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {"entries": len(self.entries), "hits": self.hits, "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0}
@@ -1,46 +1,44 @@
-import os
-import pymongo
+import time
+import numpy as np
 import streamlit as st
-from dotenv import load_dotenv
 
-from llama_index.vector_stores.mongodb import MongoDBAtlasVectorSearch
-from llama_index.core import VectorStoreIndex
-from llama_index.embeddings.openai import OpenAIEmbedding
+from llama_index.core import QueryBundle
 from llama_index.core import Settings
+from llama_index.core.base.response.schema import Response
+
+import sim_chat_engine
 
 # Set Streamlit page configuration
 st.set_page_config(page_title="Simulation AI Chat")
 st.title("Simulation AI Chat")
 
-# Load environment variables
-dotenv_path = os.path.join(os.path.dirname(__file__), '.env')
-load_dotenv(dotenv_path)
-
-key = os.getenv('OPENAI_API_KEY')
-Settings.embed_model = OpenAIEmbedding(model="text-embedding-3-small", api_key=key)
-
-# MongoDB setup
-mongo_uri = os.getenv("MONGO_URI")
-mongo_client = pymongo.MongoClient(mongo_uri)
-db = mongo_client["simulation"]
-collection = db["synthdata"]
-
-# Ensure documents are correctly embedded
-vector_store = MongoDBAtlasVectorSearch(mongo_client, db_name="simulation", collection_name="synthdata", index_name="vector_index", embedding_key="embedding")
-index = VectorStoreIndex.from_vector_store(vector_store)
-
-query_engine = index.as_query_engine(verbose=True)
-
+# Streamlit reruns this script on every interaction. The chat engine is built once per process in
+# sim_chat_engine.py and shared by every session and rerun; started with `python sim_chat_engine.py`
+# it is already loading before the first page view.
+sim_chat_engine.start()
+with st.spinner("Loading the chat engine..."):
+    query_engine, query_cache, postprocessors = sim_chat_engine.get_engine()
 # Initialize the chat messages history
 if 'messages' not in st.session_state:
     st.session_state.messages = [
         {"role": "assistant", "content": "How can I assist you today?"}
     ]
 
+# First-token and total latency of each turn in this session
+if 'turn_latencies' not in st.session_state:
+    st.session_state.turn_latencies = []
+
 # Function to add a new message to the chat history
 def add_message(sender, message):
     st.session_state.messages.append({"role": sender, "content": message})
 
+def timed_tokens(tokens, timings):
+    # Passes the streamed tokens through, noting when the first one arrived
+    for token in tokens:
+        if "first_token" not in timings:
+            timings["first_token"] = time.perf_counter()
+        yield token
+
 # Display the chat messages history
 for msg in st.session_state.messages:
     with st.chat_message(msg["role"]):
@@ -55,32 +53,63 @@ if prompt := st.chat_input("Enter your query (or type 'exit' to quit):"):
         st.stop()
 
     with st.chat_message("assistant"):
-        with st.spinner("Thinking..."):
-            # Send the query to the AI and get the response
-            response = query_engine.query(prompt)
-
-            if response:
-                try:
-                    ai_response = response.response  # Accessing the response text
-                    if ai_response == 'Empty Response':
-                        st.write("No meaningful response from the AI.")
-                        add_message("assistant", "Sorry, I couldn't get a meaningful response for that query.")
-                    else:
-                        st.write(ai_response)
-                        add_message("assistant", ai_response)
-
-                    # Retrieve and display relevant documents from source_nodes
-                    if response.source_nodes:
-                        for node in response.source_nodes:
-                            with st.expander(f"Document ID: {node.id_}"):
-                                st.write(f"**Text:** {node.text}")
-                                st.write(f"**Score:** {node.metadata.get('score', 'N/A')}")
-                                st.write(f"**Metadata:** {node.metadata}")
-                    else:
-                        st.write("No relevant documents found.")
-                except AttributeError as e:
-                    st.write("Error retrieving response:", str(e))
-                    add_message("assistant", "Sorry, I couldn't process that request.")
+        started = time.perf_counter()
+        with st.spinner("Searching..."):
+            # The query is embedded once; a near-duplicate of a cached question skips retrieval and synthesis
+            embedding = Settings.embed_model.get_query_embedding(prompt)
+            embedded = time.perf_counter()
+            cached = query_cache.get(embedding) if query_cache else None
+            if cached:
+                response, similarity = cached
             else:
-                st.write("Received an empty response from the query engine.")
-                add_message("assistant", "Sorry, I couldn't get a response for that query.")
+                # Retrieval happens here; the answer is then synthesized as a stream of tokens
+                response = query_engine.query(QueryBundle(prompt, embedding=embedding))
+
+        answer = st.empty()
+        # Retrieve and display relevant documents from source_nodes while the answer streams in above them
+        if response.source_nodes:
+            for node in response.source_nodes:
+                with st.expander(f"Document ID: {node.id_}"):
+                    st.write(f"**Text:** {node.text}")
+                    st.write(f"**Score:** {node.score if node.score is not None else 'N/A'}")
+                    st.write(f"**Metadata:** {node.metadata}")
+        else:
+            st.write("No relevant documents found.")
+
+        timings = {}
+        if cached:
+            ai_response = response.response
+            answer.write(ai_response)
+            timings["first_token"] = time.perf_counter()
+        else:
+            ai_response = answer.write_stream(timed_tokens(response.response_gen, timings))
+        finished = time.perf_counter()
+
+        if not ai_response or ai_response == 'Empty Response':
+            answer.write("No meaningful response from the AI.")
+            add_message("assistant", "Sorry, I couldn't get a meaningful response for that query.")
+        else:
+            add_message("assistant", ai_response)
+            if query_cache and not cached:
+                query_cache.put(embedding, Response(ai_response, response.source_nodes, response.metadata), finished - embedded)
+
+        turn = {"first_token_seconds": timings.get("first_token", finished) - started, "total_seconds": finished - started, "cached": bool(cached)}
+        context = postprocessors[0].last_stats() if postprocessors and not cached else None
+        if context:
+            turn.update(prompt_tokens=context["prompt_tokens"], chunks=f"{context['kept']}/{context['candidates']}")
+        st.session_state.turn_latencies.append(turn)
+        summary = f"First token {turn['first_token_seconds']:.2f}s, total {turn['total_seconds']:.2f}s"
+        if context:
+            summary += f", ~{context['prompt_tokens']} prompt tokens from {context['kept']} of {context['candidates']} chunks"
+        if cached:
+            summary += f", answered from the cache (similarity {similarity:.3f})"
+        print(f"Chat turn: {summary}")
+        st.caption(summary)
+
+# Rendered last so the figures include this turn
+if st.session_state.turn_latencies:
+    st.sidebar.metric("Median time to first token", f"{np.median([turn['first_token_seconds'] for turn in st.session_state.turn_latencies]):.2f}s")
+if query_cache:
+    stats = query_cache.stats()
+    st.sidebar.metric("Query cache hit rate", f"{stats['hit_rate']:.0%}", help=f"{stats['hits']} hits, {stats['misses']} misses, {stats['entries']} cached")
+    st.sidebar.metric("Time saved by the cache", f"{stats['seconds_saved']:.1f}s")
@@ -0,0 +1,134 @@
+import os
+import sys
+import json
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pymongo
+from dotenv import load_dotenv
+
+from llama_index.core import VectorStoreIndex, QueryBundle
+from llama_index.embeddings.openai import OpenAIEmbedding
+from llama_index.core import Settings
+from llama_index.core.query_engine import RetrieverQueryEngine
+
+from sim_cache import SemanticCache
+from sim_lexical import build_retriever
+from sim_postprocess import build_postprocessors
+from sim_vectors import build_vector_store, vector_version
+
+# Load environment variables
+dotenv_path = os.path.join(os.path.dirname(__file__), '.env')
+load_dotenv(dotenv_path)
+
+# The chat engine of sim_chat.py and its readiness endpoint, one per process. Streamlit only runs
+# sim_chat.py when a browser session opens, so `python sim_chat_engine.py` starts both here first and
+# then serves the app in the same process, where sim_chat.py picks up the engine already loading.
+status = {"ready": False, "started_at": time.time()}
+_lock = threading.Lock()
+_loader = None
+_engine = None
+_health_server = None
+
+def start_health_server():
+    # Readiness served as JSON on SIM_CHAT_HEALTH_HOST:SIM_CHAT_HEALTH_PORT (port 0 disables it): 503 while
+    # the engine is loading and warming up, 200 once chat turns only pay for retrieval and synthesis.
+    # It listens on localhost only unless the host is set, e.g. to 0.0.0.0 for a container probe.
+    global _health_server
+    host = os.getenv("SIM_CHAT_HEALTH_HOST", "127.0.0.1")
+    port = int(os.getenv("SIM_CHAT_HEALTH_PORT", "8502"))
+
+    class HealthHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.rstrip("/") != "/health":
+                self.send_error(404)
+                return
+            body = json.dumps(status).encode("utf-8")
+            self.send_response(200 if status["ready"] else 503)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    if port and _health_server is None:
+        try:
+            _health_server = ThreadingHTTPServer((host, port), HealthHandler)
+            threading.Thread(target=_health_server.serve_forever, daemon=True).start()
+        except OSError as e:
+            print(f"Health endpoint not started on {host}:{port}: {e}")
+
+def load_engine():
+    started = time.perf_counter()
+    key = os.getenv('OPENAI_API_KEY')
+    Settings.embed_model = OpenAIEmbedding(model="text-embedding-3-small", api_key=key, dimensions=int(os.getenv("SIM_EMBED_DIMENSIONS", "1536")))
+
+    # MongoDB setup; the client keeps a connection pool that every session shares
+    mongo_client = pymongo.MongoClient(os.getenv("MONGO_URI"))
+
+    # Atlas Vector Search, or the local store when SIM_VECTOR_BACKEND=local
+    vector_store = build_vector_store(mongo_client)
+    index = VectorStoreIndex.from_vector_store(vector_store)
+    # SIM_RETRIEVER=hybrid adds a BM25 index over synthdata that follows its change stream
+    retriever = build_retriever(index, mongo_client["simulation"]["synthdata"], follow=True)
+    # MMR diversification and context packing, unless SIM_MMR=off
+    postprocessors = build_postprocessors(vector_store)
+    query_engine = RetrieverQueryEngine.from_args(retriever, node_postprocessors=postprocessors, verbose=True, streaming=True)
+
+    # The semantic query cache is cleared whenever the vector collection changes
+    query_cache = SemanticCache.from_env(version=lambda: vector_version(vector_store, mongo_client))
+    status["load_seconds"] = round(time.perf_counter() - started, 3)
+
+    # Warm-up: opens the OpenAI and MongoDB connections and runs one retrieval (paging in a local
+    # store), so the first real question does not pay for it
+    started = time.perf_counter()
+    embedding = Settings.embed_model.get_query_embedding("warm-up")
+    retriever.retrieve(QueryBundle("warm-up", embedding=embedding))
+    status.update(ready=True, warmup_seconds=round(time.perf_counter() - started, 3))
+    return query_engine, query_cache, postprocessors
+
+def _load_in_background():
+    global _engine, _loader
+    try:
+        _engine = load_engine()
+        status.pop("error", None)
+    except Exception as e:
+        # Recorded for /health; the next start() or get_engine() tries again
+        status["error"] = str(e)
+        print(f"Loading the chat engine failed: {e}")
+        with _lock:
+            _loader = None
+
+def start():
+    # Starts the health endpoint and loads the engine in a background thread; later calls do nothing
+    # while it is loading or loaded
+    global _loader
+    with _lock:
+        start_health_server()
+        if _engine is None and _loader is None:
+            _loader = threading.Thread(target=_load_in_background, name="chat-engine-loader", daemon=True)
+            _loader.start()
+        return _loader
+
+def get_engine():
+    # (query_engine, query_cache, postprocessors), waiting for the load to finish
+    loader = start()
+    if loader is not None:
+        loader.join()
+    if _engine is None:
+        raise RuntimeError(f"The chat engine could not be loaded: {status.get('error')}")
+    return _engine
+
+def main():
+    # Imported under its own name, so sim_chat.py, run by Streamlit in this process, shares the
+    # engine instead of getting a second copy of this script's module
+    import sim_chat_engine
+    sim_chat_engine.start()
+    from streamlit.web import cli
+    sys.argv = ["streamlit", "run", os.path.join(os.path.dirname(os.path.abspath(__file__)), "sim_chat.py")] + sys.argv[1:]
+    sys.exit(cli.main())
+
+if __name__ == "__main__":
+    main()
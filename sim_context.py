@@ -0,0 +1,196 @@
+import numpy as np
+
+CONTEXT_STRATEGIES = ["full", "recent", "representative"]
+EMBEDDING_MODEL = "text-embedding-3-small"
+# The embeddings endpoint takes at most 2048 inputs per request
+MAX_EMBED_INPUTS = 2048
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+def load_encoding():
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.encoding_for_model("gpt-4o")
+    except KeyError:
+        # Older tiktoken releases do not know gpt-4o yet
+        return tiktoken.get_encoding("o200k_base" if "o200k_base" in tiktoken.list_encoding_names() else "cl100k_base")
+    except Exception:
+        return None
+
+_encoding = load_encoding()
+
+def count_tokens(text):
+    if _encoding is not None:
+        return len(_encoding.encode(text))
+    return max(1, len(text) // 4)
+
+def count_message_tokens(messages):
+    # Roughly 4 tokens of chat framing per message on top of the content
+    return sum(count_tokens(message["content"]) + 4 for message in messages)
+
+def normalize_rows(matrix):
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+def nearest_centroids(vectors, centroids, block_size=1 << 24):
+    # Index of the highest scoring centroid for every row. Scores are computed in blocks of rows and
+    # centroids of at most block_size entries, so neither a memory-mapped matrix nor a large codebook
+    # is multiplied out whole
+    centroid_chunk = min(len(centroids), 4096)
+    row_chunk = max(1, block_size // max(1, centroid_chunk))
+    nearest = np.empty(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), row_chunk):
+        rows = np.asarray(vectors[start:start + row_chunk], dtype=np.float32)
+        best = np.full(len(rows), -np.inf, dtype=np.float32)
+        for first in range(0, len(centroids), centroid_chunk):
+            scores = rows @ centroids[first:first + centroid_chunk].T
+            column = np.argmax(scores, axis=1)
+            score = scores[np.arange(len(rows)), column]
+            better = score > best
+            best[better] = score[better]
+            nearest[start:start + len(rows)][better] = column[better] + first
+    return nearest
+
+def kmeans(vectors, k, iterations=10, block_size=1 << 24):
+    # Deterministic initialisation from evenly spaced rows keeps reruns of a scenario comparable.
+    # Assignments and centroid sums are computed a block of rows at a time.
+    centroids = np.asarray(vectors[np.linspace(0, len(vectors) - 1, k).astype(int)], dtype=np.float32).copy()
+    row_chunk = max(1, block_size // max(1, min(k, 4096)))
+    for _ in range(iterations):
+        assignments = nearest_centroids(vectors, centroids, block_size)
+        sums = np.zeros_like(centroids)
+        for start in range(0, len(vectors), row_chunk):
+            chunk = assignments[start:start + row_chunk]
+            order = np.argsort(chunk, kind="stable")
+            clusters, starts = np.unique(chunk[order], return_index=True)
+            sums[clusters] += np.add.reduceat(np.asarray(vectors[start:start + row_chunk], dtype=np.float32)[order], starts, axis=0)
+        # Empty clusters keep their previous centroid
+        counts = np.bincount(assignments, minlength=k)
+        filled = counts > 0
+        centroids[filled] = sums[filled] / counts[filled, np.newaxis]
+        centroids = normalize_rows(centroids)
+    return centroids, nearest_centroids(vectors, centroids, block_size)
+
+
+# Builds the "previous questions" part of the question prompt within a fixed token budget,
+# and optionally drops generated questions that are too close to ones already kept
+class PriorContext:
+    def __init__(self, strategy="full", token_budget=1500, novelty_threshold=0.0, llm=None):
+        if strategy not in CONTEXT_STRATEGIES:
+            raise ValueError(f"Unknown context strategy '{strategy}', expected one of {CONTEXT_STRATEGIES}")
+        self.strategy = strategy
+        self.token_budget = token_budget
+        self.novelty_threshold = novelty_threshold
+        self.llm = llm
+        self.embeddings = {}
+        # Vectors of the questions kept so far, in the first kept_count rows of a buffer that doubles when full
+        self.kept_vectors = None
+        self.kept_count = 0
+        self.prompt_tokens = []
+        self.dropped = 0
+
+    def build(self, question_texts):
+        if not question_texts:
+            return ""
+        joined = " ".join(question_texts)
+        if self.strategy == "full" or count_tokens(joined) <= self.token_budget:
+            return joined
+        if self.strategy == "representative":
+            try:
+                return " ".join(self._representative(question_texts))
+            except Exception as e:
+                print(f"Falling back to recent questions, failed to embed prior questions: {e}")
+        return " ".join(self._fit_budget(reversed(question_texts))[::-1])
+
+    def filter_novel(self, questions_json):
+        if self.novelty_threshold <= 0 or not questions_json:
+            return questions_json
+        texts = [q.get('question_text', q.get('text', '')) for q in questions_json]
+        try:
+            vectors = self.embed(texts)
+        except Exception as e:
+            print(f"Novelty filter skipped, failed to embed questions: {e}")
+            return questions_json
+        novel = []
+        for question, vector in zip(questions_json, vectors):
+            if self.kept_count and float(np.max(self.kept_vectors[:self.kept_count] @ vector)) >= self.novelty_threshold:
+                self.dropped += 1
+                print(f"Dropped near-duplicate question: {question.get('question_text', question.get('text', ''))}")
+                continue
+            novel.append(question)
+            self._keep(vector[np.newaxis, :])
+        return novel
+
+    def seed(self, question_texts):
+        # Questions stored by an earlier session of the run, so a resumed run's new questions are
+        # compared with them too
+        if self.novelty_threshold <= 0 or not question_texts:
+            return
+        try:
+            self._keep(self.embed(question_texts))
+        except Exception as e:
+            print(f"Novelty filter not seeded with the run's earlier questions, failed to embed them: {e}")
+
+    def embed(self, texts):
+        missing = [text for text in dict.fromkeys(texts) if text not in self.embeddings]
+        if missing:
+            if self.llm is None:
+                from sim_llm import LLMClient
+                self.llm = LLMClient.from_env()
+            for start in range(0, len(missing), MAX_EMBED_INPUTS):
+                batch = missing[start:start + MAX_EMBED_INPUTS]
+                for text, embedding in zip(batch, self.llm.embed(EMBEDDING_MODEL, batch)):
+                    self.embeddings[text] = np.asarray(embedding, dtype=np.float32)
+        return normalize_rows(np.vstack([self.embeddings[text] for text in texts]))
+
+    def record_prompt(self, messages, actual_tokens=None):
+        tokens = actual_tokens if actual_tokens is not None else count_message_tokens(messages)
+        self.prompt_tokens.append(tokens)
+        print(f"Question prompt {len(self.prompt_tokens)}: {tokens} tokens")
+
+    def report(self):
+        if self.prompt_tokens:
+            print(f"Question prompt tokens per iteration ({self.strategy}): {self.prompt_tokens}")
+            print(f"Total question prompt tokens: {sum(self.prompt_tokens)}")
+        if self.novelty_threshold > 0:
+            print(f"Near-duplicate questions dropped by novelty filter: {self.dropped}")
+
+    def _keep(self, vectors):
+        needed = self.kept_count + len(vectors)
+        if self.kept_vectors is None or needed > len(self.kept_vectors):
+            grown = np.empty((max(needed, 2 * self.kept_count, 64), vectors.shape[1]), dtype=np.float32)
+            if self.kept_count:
+                grown[:self.kept_count] = self.kept_vectors[:self.kept_count]
+            self.kept_vectors = grown
+        self.kept_vectors[self.kept_count:needed] = vectors
+        self.kept_count = needed
+
+    def _fit_budget(self, texts):
+        selected = []
+        used = 0
+        for text in texts:
+            tokens = count_tokens(text) + 1
+            if used + tokens > self.token_budget:
+                break
+            selected.append(text)
+            used += tokens
+        return selected
+
+    def _representative(self, question_texts):
+        # Cluster all prior questions and send the one closest to each centroid, largest clusters first
+        vectors = self.embed(question_texts)
+        average_tokens = max(1, count_tokens(" ".join(question_texts)) // len(question_texts))
+        k = max(1, min(len(question_texts), self.token_budget // (average_tokens + 1)))
+        centroids, assignments = kmeans(vectors, k)
+        similarity = vectors @ centroids.T
+        representatives = []
+        for cluster in np.argsort(-np.bincount(assignments, minlength=k)):
+            members = np.flatnonzero(assignments == cluster)
+            if len(members):
+                representatives.append(question_texts[members[np.argmax(similarity[members, cluster])]])
+        return self._fit_budget(representatives)
@@ -0,0 +1,76 @@
+import re
+import zlib
+import numpy as np
+
+MERSENNE_PRIME = (1 << 31) - 1
+MAX_HASH = (1 << 32) - 1
+WORD_PATTERN = re.compile(r"[a-z0-9]+")
+
+def shingles(text, size=2):
+    words = WORD_PATTERN.findall(text.lower())
+    if len(words) < size:
+        return {" ".join(words)}
+    return {" ".join(words[i:i + size]) for i in range(len(words) - size + 1)}
+
+def choose_bands(num_perm, threshold):
+    # Pick the bands x rows split whose LSH S-curve midpoint, (1/b)^(1/r), is closest to the threshold
+    splits = [(bands, num_perm // bands) for bands in range(1, num_perm + 1) if num_perm % bands == 0]
+    return min(splits, key=lambda split: abs((1 / split[0]) ** (1 / split[1]) - threshold))
+
+
+# MinHash signatures with banded LSH buckets, so each lookup only compares against the few
+# earlier questions that share a bucket rather than the whole scenario
+class QuestionDeduper:
+    def __init__(self, threshold=0.8, num_perm=128, shingle_size=2, seed=1):
+        self.threshold = threshold
+        self.shingle_size = shingle_size
+        rng = np.random.default_rng(seed)
+        self.a = rng.integers(1, MERSENNE_PRIME, size=num_perm, dtype=np.uint64)
+        self.b = rng.integers(0, MERSENNE_PRIME, size=num_perm, dtype=np.uint64)
+        self.bands, self.rows = choose_bands(num_perm, threshold)
+        self.buckets = [{} for _ in range(self.bands)]
+        self.signatures = {}
+        self.skipped = 0
+
+    def signature(self, text):
+        hashes = np.fromiter((zlib.crc32(s.encode("utf-8")) for s in shingles(text, self.shingle_size)), dtype=np.uint64)
+        hashes %= MERSENNE_PRIME
+        permuted = (hashes[:, np.newaxis] * self.a + self.b) % MERSENNE_PRIME
+        return permuted.min(axis=0)
+
+    def find_duplicate(self, text, signature=None):
+        signature = self.signature(text) if signature is None else signature
+        candidates = set()
+        for band, key in enumerate(self._band_keys(signature)):
+            candidates.update(self.buckets[band].get(key, ()))
+        best_key, best_similarity = None, 0.0
+        for key in candidates:
+            similarity = float(np.mean(self.signatures[key] == signature))
+            if similarity >= self.threshold and similarity > best_similarity:
+                best_key, best_similarity = key, similarity
+        return best_key
+
+    def add(self, text, key, signature=None):
+        signature = self.signature(text) if signature is None else signature
+        self.signatures[key] = signature
+        for band, band_key in enumerate(self._band_keys(signature)):
+            self.buckets[band].setdefault(band_key, []).append(key)
+
+    def check(self, text, pending=None):
+        # Returns (key of an earlier near-duplicate or None, signature) without indexing the text, so it can
+        # be added once stored. `pending` maps keys not indexed yet, such as earlier questions of the same
+        # set, to their signatures
+        signature = self.signature(text)
+        duplicate = self.find_duplicate(text, signature)
+        if duplicate is None and pending:
+            duplicate = next((key for key, other in pending.items() if np.mean(other == signature) >= self.threshold), None)
+        if duplicate is not None:
+            self.skipped += 1
+        return duplicate, signature
+
+    def report(self):
+        print(f"Near-duplicate questions skipped: {self.skipped} answer calls saved "
+              f"({len(self.signatures)} unique questions indexed, threshold {self.threshold})")
+
+    def _band_keys(self, signature):
+        return [signature[band * self.rows:(band + 1) * self.rows].tobytes() for band in range(self.bands)]
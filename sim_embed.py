@@ -1,16 +1,32 @@
 import os
 import json
+import time
+import hashlib
+import asyncio
+import argparse
 import pymongo
-from llama_index.core import Document, VectorStoreIndex
-from llama_index.core.settings import Settings
-from llama_index.llms.openai import OpenAI
-from llama_index.embeddings.openai import OpenAIEmbedding
-from llama_index.vector_stores.mongodb import MongoDBAtlasVectorSearch
+from pymongo import ReplaceOne, UpdateOne
+from llama_index.core import Document
+from llama_index.core.schema import MetadataMode
+from llama_index.core.vector_stores.utils import node_to_metadata_dict
 from llama_index.core.node_parser import SentenceSplitter
-from llama_index.core.response.notebook_utils import display_response
 from dotenv import load_dotenv
 import logging
 
+from sim_context import count_tokens
+from sim_llm import LLMClient
+from sim_quant import EMBEDDING_ENCODINGS, encode_embedding
+from sim_sources import SOURCE_FILTER, source_id_value, source_text
+from sim_vectors import mark_vectors_changed
+
+EMBED_MODEL = "text-embedding-3-small"
+EMBED_DIMENSIONS = 1536
+# The embeddings endpoint rejects requests above roughly 300k tokens, so batches stop short of that
+MAX_BATCH_TOKENS = 250000
+# Raw questions and answers are read from RAW_COLLECTION and their vector nodes written to VECTOR_COLLECTION
+RAW_COLLECTION = "synthdata"
+VECTOR_COLLECTION = "synthdata_vectors"
+
 # Setup logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
@@ -19,61 +35,288 @@ dotenv_path = os.path.join(os.path.dirname(__file__), '.env')
 load_dotenv(dotenv_path)
 logging.info("Environment variables loaded.")
 
-# Ensure the OPENAI_API_KEY and MONGO_URI environment variables are set
-if "OPENAI_API_KEY" not in os.environ or "MONGO_URI" not in os.environ:
-    logging.critical("OPENAI_API_KEY or MONGO_URI not set in environment variables")
-    raise EnvironmentError("OPENAI_API_KEY or MONGO_URI not set in environment variables")
-
-# MongoDB setup
-mongo_uri = os.getenv("MONGO_URI")
-mongo_client = pymongo.MongoClient(mongo_uri)
-db = mongo_client["simulation"]
-collection = db["synthdata"]
-
-# Fetch data from MongoDB
-documents = list(collection.find({}))
-
-# Setup embedding and LLM models
-embed_model = OpenAIEmbedding(model="text-embedding-3-small", dimensions=1536)
-Settings.embed_model = embed_model
-
-# Ensure that the embedding model is correctly set in the settings
-if Settings.embed_model.dimensions != 1536:
-    logging.critical("Embedding model dimensions are not set to 1536. Please check the model configuration.")
-    raise ValueError("Embedding model dimensions are not set to 1536. Please check the model configuration.")
-llm = OpenAI()
-Settings.llm = llm
-Settings.embed_model = embed_model
-logging.info("Embedding and LLM models set up.")
-
-# Convert MongoDB documents to list of Document objects
-llama_documents = []
-for doc in documents:
-    metadata = doc['metadata']
-    full_text = f"Question: {metadata['question_text']} Answer: {metadata['answer']}"  # Combine question and answer
-    llama_document = Document(
-        text=full_text,  # Use combined text for embedding
-        metadata=metadata,
-        excluded_llm_metadata_keys=["answer"],  # Adjust if necessary
-        excluded_embed_metadata_keys=["answer"],  # Adjust if necessary
-        metadata_template="{key}=>{value}",
-        text_template="{content}\nMetadata: {metadata_str}"
-    )
-    llama_documents.append(llama_document)
-logging.info("Documents converted to Llama Document format with both question and answer embedded.")
-
-# Parse documents into nodes and embed
-parser = SentenceSplitter()
-nodes = parser.get_nodes_from_documents(llama_documents)
-for node in nodes:
-    node_embedding = embed_model.get_text_embedding(node.get_content(metadata_mode="all"))
-    node.embedding = node_embedding
-logging.info("Documents parsed into nodes and embedded.")
-
-# Clear existing data in MongoDB collection
-collection.delete_many({})
-
-# Create and populate vector store
-vector_store = MongoDBAtlasVectorSearch(mongo_client, db_name="simulation", collection_name="synthdata", index_name="vector_index")
-vector_store.add(nodes)
-logging.info("Vector store created and populated.")
\ No newline at end of file
+def check_environment():
+    # Ensure the OPENAI_API_KEY and MONGO_URI environment variables are set
+    if "OPENAI_API_KEY" not in os.environ or "MONGO_URI" not in os.environ:
+        logging.critical("OPENAI_API_KEY or MONGO_URI not set in environment variables")
+        raise EnvironmentError("OPENAI_API_KEY or MONGO_URI not set in environment variables")
+
+def connect_to_mongodb(vector_collection=VECTOR_COLLECTION):
+    mongo_client = pymongo.MongoClient(os.getenv("MONGO_URI"))
+    db = mongo_client["simulation"]
+    return mongo_client, db[RAW_COLLECTION], db[vector_collection]
+
+def ensure_indexes(collection):
+    # Vector nodes are looked up and replaced by the source document they were split from
+    collection.create_index([('metadata.ref_doc_id', pymongo.ASCENDING)], name='vector_node_source')
+
+def content_hash(metadata, dimensions=EMBED_DIMENSIONS):
+    # Covers everything that ends up in a node, plus the model and dimensions, so changing either re-embeds too
+    payload = json.dumps({'model': EMBED_MODEL, 'dimensions': dimensions, 'metadata': metadata}, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+def load_node_hashes(vectors, source_ids):
+    # Maps each of the given source document ids to the content hashes of its stored nodes
+    hashes = {}
+    for node in vectors.find({'metadata.ref_doc_id': {'$in': source_ids}}, {'metadata.ref_doc_id': 1, 'metadata.content_hash': 1}):
+        if 'content_hash' not in node['metadata']:
+            continue
+        hashes.setdefault(node['metadata']['ref_doc_id'], set()).add(node['metadata']['content_hash'])
+    return hashes
+
+def build_documents(documents):
+    # Convert MongoDB documents to list of Document objects. The source _id becomes the document id,
+    # so node ids (and the ref_doc_id stored with every node) are stable across runs.
+    llama_documents = []
+    for doc in documents:
+        metadata = dict(doc['metadata'], content_hash=doc['content_hash'])
+        full_text = source_text(metadata)  # Combine question and answer
+        llama_document = Document(
+            id_=str(doc['_id']),
+            text=full_text,  # Use combined text for embedding
+            metadata=metadata,
+            excluded_llm_metadata_keys=["answer", "content_hash"],  # Adjust if necessary
+            excluded_embed_metadata_keys=["answer", "content_hash"],  # Adjust if necessary
+            metadata_template="{key}=>{value}",
+            text_template="{content}\nMetadata: {metadata_str}"
+        )
+        llama_documents.append(llama_document)
+    return llama_documents
+
+def node_id(i, document):
+    return f"{document.doc_id}-{i}"
+
+def node_entry(node, encoding="array"):
+    # Same layout MongoDBAtlasVectorSearch.add() writes, so the query side reads these nodes unchanged
+    return {
+        '_id': node.node_id,
+        'embedding': encode_embedding(node.get_embedding(), encoding),
+        'text': node.get_content(metadata_mode=MetadataMode.NONE) or "",
+        'metadata': node_to_metadata_dict(node, remove_text=True, flat_metadata=False)
+    }
+
+def write_nodes(collection, nodes, batch_size=500, encoding="array"):
+    # Replaces each source's nodes in place, then drops chunks a shorter new version no longer has.
+    # Sources with any chunk left unembedded keep their old nodes and hash, so the next run retries them.
+    by_source = {}
+    for node in nodes:
+        by_source.setdefault(node.ref_doc_id, []).append(node)
+    complete = {source: group for source, group in by_source.items() if all(node.embedding is not None for node in group)}
+    sources = list(complete)
+    for start in range(0, len(sources), batch_size):
+        batch = [node for source in sources[start:start + batch_size] for node in complete[source]]
+        collection.bulk_write([ReplaceOne({'_id': node.node_id}, node_entry(node, encoding), upsert=True) for node in batch], ordered=False)
+        collection.delete_many({'metadata.ref_doc_id': {'$in': sources[start:start + batch_size]},
+                                '_id': {'$nin': [node.node_id for node in batch]}})
+    if complete:
+        mark_vectors_changed(collection)
+    return len(complete), len(by_source) - len(complete)
+
+def migrate_legacy_nodes(raw, batch_size=500):
+    # Older versions of this script replaced synthdata with its vector nodes, so for those users the
+    # nodes are the only copy of the generated questions. Rebuilds one raw question per source document
+    # from them, keyed on the node's ref_doc_id so rerunning never duplicates it; returns the number added.
+    groups = raw.aggregate([
+        {'$match': {'embedding': {'$exists': True}, 'metadata.question_text': {'$exists': True}}},
+        {'$sort': {'metadata.ref_doc_id': 1}},
+        {'$group': {'_id': '$metadata.ref_doc_id', 'question_text': {'$first': '$metadata.question_text'},
+                    'answer': {'$first': '$metadata.answer'}, 'number': {'$first': '$metadata.number'}}}
+    ], allowDiskUse=True)
+    added = 0
+    for chunk in iter_chunks(groups, batch_size):
+        operations = []
+        for group in chunk:
+            metadata = {key: group[key] for key in ('question_text', 'answer', 'number') if group.get(key) is not None}
+            operations.append(UpdateOne({'migrated_from': group['_id']}, {'$setOnInsert': {'metadata': metadata}}, upsert=True))
+        added += raw.bulk_write(operations, ordered=False).upserted_count
+    return added
+
+def iter_chunks(cursor, chunk_size):
+    chunk = []
+    for doc in cursor:
+        chunk.append(doc)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def stored_sources(vectors, chunk_size):
+    # Distinct source ids in the vector collection, read in index order without loading them all
+    previous = None
+    cursor = vectors.find({'metadata.content_hash': {'$exists': True}}, {'metadata.ref_doc_id': 1}, batch_size=chunk_size).sort('metadata.ref_doc_id', 1)
+    for node in cursor:
+        source = node['metadata']['ref_doc_id']
+        if source != previous:
+            yield source
+            previous = source
+
+def delete_removed_sources(raw, vectors, chunk_size):
+    # Deletes, a chunk of sources at a time, the nodes whose source document is gone or no longer answered
+    removed = 0
+    for source_ids in iter_chunks(stored_sources(vectors, chunk_size), chunk_size):
+        present = {str(doc['_id']) for doc in raw.find({'_id': {'$in': [source_id_value(s) for s in source_ids]}, **SOURCE_FILTER}, {'_id': 1})}
+        gone = [source for source in source_ids if source not in present]
+        if gone:
+            vectors.delete_many({'metadata.ref_doc_id': {'$in': gone}})
+            removed += len(gone)
+    if removed:
+        mark_vectors_changed(vectors)
+    return removed
+
+def make_batches(nodes, batch_size, max_batch_tokens=MAX_BATCH_TOKENS):
+    # Groups nodes into (nodes, texts, tokens) batches of at most batch_size inputs and max_batch_tokens tokens
+    batches = []
+    current, texts, tokens = [], [], 0
+    for node in nodes:
+        text = node.get_content(metadata_mode="all")
+        text_tokens = count_tokens(text)
+        if current and (len(current) >= batch_size or tokens + text_tokens > max_batch_tokens):
+            batches.append((current, texts, tokens))
+            current, texts, tokens = [], [], 0
+        current.append(node)
+        texts.append(text)
+        tokens += text_tokens
+    if current:
+        batches.append((current, texts, tokens))
+    return batches
+
+
+# Tracks embedded chunks and tokens and logs throughput every `report_every` batches
+class EmbedProgress:
+    def __init__(self, report_every=10):
+        self.report_every = report_every
+        self.chunks = 0
+        self.tokens = 0
+        self.batches = 0
+        self.started = time.perf_counter()
+
+    def record(self, chunks, tokens):
+        self.chunks += chunks
+        self.tokens += tokens
+        self.batches += 1
+        if self.batches % self.report_every == 0:
+            self.report()
+
+    def report(self):
+        elapsed = time.perf_counter() - self.started
+        logging.info(f"Embedded {self.chunks} chunks in {elapsed:.1f}s "
+                     f"({self.chunks / elapsed if elapsed else 0:.1f} chunks/s, {self.tokens / elapsed if elapsed else 0:.0f} tokens/s)")
+
+async def embed_batches(llm, batches, concurrency, progress, dimensions=EMBED_DIMENSIONS):
+    # Sends up to `concurrency` batch requests at once; the client paces them under the account's
+    # rate limits and retries transient errors. Returns the batches that still failed.
+    semaphore = asyncio.Semaphore(concurrency)
+    failed = []
+
+    async def embed_batch(batch):
+        nodes, texts, tokens = batch
+        async with semaphore:
+            try:
+                embeddings = await llm.aembed(EMBED_MODEL, texts, dimensions=dimensions)
+                if len(embeddings) != len(nodes):
+                    raise ValueError(f"expected {len(nodes)} embeddings, got {len(embeddings)}")
+            except Exception as e:
+                logging.error(f"Embedding batch of {len(nodes)} chunks failed: {e}")
+                failed.append(batch)
+                return
+        for node, embedding in zip(nodes, embeddings):
+            node.embedding = embedding
+        progress.record(len(nodes), tokens)
+
+    await asyncio.gather(*(embed_batch(batch) for batch in batches))
+    return failed
+
+async def embed_nodes(llm, nodes, batch_size, concurrency, batch_retries, progress, dimensions=EMBED_DIMENSIONS):
+    batches = make_batches(nodes, batch_size)
+    failed = await embed_batches(llm, batches, concurrency, progress, dimensions)
+    # Only the batches that failed are sent again
+    for attempt in range(batch_retries):
+        if not failed:
+            break
+        logging.warning(f"Retrying {len(failed)} failed batches (attempt {attempt + 1}/{batch_retries}).")
+        failed = await embed_batches(llm, failed, concurrency, progress, dimensions)
+    return sum(len(batch[0]) for batch in failed)
+
+def new_stats():
+    return {'documents': 0, 'changed': 0, 'written': 0, 'skipped': 0, 'unembedded': 0}
+
+async def embed_documents(vectors, llm, documents, args, parser, progress, stats, full=False):
+    # Splits, embeds and upserts whichever of `documents` are new or changed since they were last embedded
+    stored_hashes = {} if full else load_node_hashes(vectors, [str(doc['_id']) for doc in documents])
+    for doc in documents:
+        doc['content_hash'] = content_hash(doc['metadata'], args.dimensions)
+    changed = [doc for doc in documents if stored_hashes.get(str(doc['_id'])) != {doc['content_hash']}]
+    stats['documents'] += len(documents)
+    stats['changed'] += len(changed)
+    if not changed:
+        return
+    nodes = parser.get_nodes_from_documents(build_documents(changed))
+    stats['unembedded'] += await embed_nodes(llm, nodes, args.batch_size, args.concurrency, args.batch_retries, progress, args.dimensions)
+    written, skipped = write_nodes(vectors, nodes, encoding=args.vector_encoding)
+    stats['written'] += written
+    stats['skipped'] += skipped
+
+async def sync_vectors(raw, vectors, llm, args, full=False):
+    # Streams answered questions through the splitter, embedder and writer `chunk_size` documents at
+    # a time, so memory stays flat however large the raw collection grows
+    stats = new_stats()
+    parser = SentenceSplitter(id_func=node_id)
+    progress = EmbedProgress()
+    cursor = raw.find(SOURCE_FILTER, {'metadata': 1}, batch_size=args.chunk_size)
+    for documents in iter_chunks(cursor, args.chunk_size):
+        await embed_documents(vectors, llm, documents, args, parser, progress, stats, full)
+        logging.info(f"{stats['documents']} questions read, {stats['changed']} new or changed, {stats['written']} re-embedded.")
+    progress.report()
+    return stats
+
+def add_embed_arguments(parser):
+    # Options shared by sim_embed.py and the change stream worker in sim_embed_worker.py
+    parser.add_argument("--batch-size", type=int, default=100, help="Chunks sent per embedding request")
+    parser.add_argument("--concurrency", type=int, default=4, help="Embedding requests in flight at once")
+    parser.add_argument("--batch-retries", type=int, default=2, help="Extra passes over batches that still failed after retries")
+    parser.add_argument("--chunk-size", type=int, default=500, help="Source documents read, embedded and written per step")
+    parser.add_argument("--vector-collection", default=VECTOR_COLLECTION, help="Collection in the simulation database that holds the vector nodes")
+    parser.add_argument("--dimensions", type=int, default=int(os.getenv("SIM_EMBED_DIMENSIONS", EMBED_DIMENSIONS)),
+                        help="Embedding dimensions requested from the model (Matryoshka truncation); queries use SIM_EMBED_DIMENSIONS")
+    parser.add_argument("--vector-encoding", choices=EMBEDDING_ENCODINGS, default="array",
+                        help="How embeddings are stored: BSON array of doubles, or a packed float32 vector")
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Embed the stored questions and answers into the vector store")
+    add_embed_arguments(parser)
+    parser.add_argument("--full", action="store_true", help="Re-embed every document and drop nodes left by older versions")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    check_environment()
+    mongo_client, raw, vectors = connect_to_mongodb(args.vector_collection)
+    ensure_indexes(vectors)
+
+    if raw.find_one({'embedding': {'$exists': True}}, {'_id': 1}):
+        logging.info(f"Rebuilt {migrate_legacy_nodes(raw, args.chunk_size)} questions from vector nodes written into {RAW_COLLECTION} by older versions.")
+
+    llm = LLMClient.from_env()
+    stats = asyncio.run(sync_vectors(raw, vectors, llm, args, args.full))
+    llm.report()
+    if stats['documents'] == 0:
+        logging.warning("No answered questions found; the vector store was left untouched.")
+        return
+
+    # Nodes are upserted in place, so the vector store is never empty while it is being refreshed
+    removed = delete_removed_sources(raw, vectors, args.chunk_size)
+    if args.full:
+        # Nodes written before content hashes were tracked, or into the raw collection, have no source to
+        # match. The raw collection's nodes were rebuilt into questions above, so only their vectors go.
+        if vectors.delete_many({'metadata.content_hash': {'$exists': False}}).deleted_count:
+            mark_vectors_changed(vectors)
+        raw.delete_many({'embedding': {'$exists': True}})
+    logging.info(f"Vector store {args.vector_collection} updated: {stats['documents']} answered questions, "
+                 f"{stats['written']} re-embedded, {stats['documents'] - stats['changed']} unchanged, {removed} removed.")
+    if stats['unembedded']:
+        logging.critical(f"{stats['unembedded']} chunks could not be embedded; {stats['skipped']} documents kept their previous vectors and will be retried on the next run.")
+        raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+import time
+import asyncio
+import argparse
+import logging
+from datetime import datetime, timezone
+from pymongo.errors import OperationFailure
+from llama_index.core.node_parser import SentenceSplitter
+
+import sim_embed
+from sim_llm import LLMClient
+from sim_sources import WATCH_PIPELINE, is_source
+from sim_vectors import mark_vectors_changed
+
+# One resume token per vector collection, so several workers can feed different vector collections
+STATE_COLLECTION = "embed_worker_state"
+# Returned when a resume token has already rolled off the oplog
+CHANGE_STREAM_HISTORY_LOST = 286
+
+def touches_metadata(change):
+    if change['operationType'] != 'update':
+        return True
+    description = change.get('updateDescription') or {}
+    fields = list(description.get('updatedFields') or {}) + list(description.get('removedFields') or [])
+    return any(field == 'metadata' or field.startswith('metadata.') for field in fields)
+
+def load_resume_token(state, name):
+    doc = state.find_one({'_id': name})
+    return doc.get('resume_token') if doc else None
+
+def save_resume_token(state, name, token):
+    state.update_one({'_id': name}, {'$set': {'resume_token': token, 'updated_at': datetime.now(timezone.utc)}}, upsert=True)
+
+def next_changes(stream, max_changes, max_wait):
+    # Collects a micro-batch: up to max_changes events, or whatever arrived within max_wait seconds
+    changes = []
+    deadline = time.monotonic() + max_wait
+    while len(changes) < max_changes and time.monotonic() < deadline:
+        change = stream.try_next()
+        if change is not None:
+            changes.append(change)
+    return changes
+
+async def apply_changes(vectors, llm, changes, args, parser, progress, stats):
+    # Only the latest state of each document matters; deletes and updates that clear the answer drop its nodes
+    latest = {}
+    for change in changes:
+        if touches_metadata(change):
+            latest[change['documentKey']['_id']] = change.get('fullDocument')
+    documents = [{'_id': key, 'metadata': doc['metadata']} for key, doc in latest.items() if doc is not None and is_source(doc)]
+    removed = [str(key) for key, doc in latest.items() if doc is None or not is_source(doc)]
+    if removed:
+        if vectors.delete_many({'metadata.ref_doc_id': {'$in': removed}}).deleted_count:
+            mark_vectors_changed(vectors)
+    if documents:
+        await sim_embed.embed_documents(vectors, llm, documents, args, parser, progress, stats)
+    return len(documents), len(removed)
+
+async def watch(raw, vectors, state, llm, args):
+    name = args.vector_collection
+    parser = SentenceSplitter(id_func=sim_embed.node_id)
+    progress = sim_embed.EmbedProgress()
+    stats = sim_embed.new_stats()
+    while True:
+        token = load_resume_token(state, name)
+        try:
+            with raw.watch(WATCH_PIPELINE, full_document='updateLookup', resume_after=token,
+                           max_await_time_ms=int(args.max_wait * 1000)) as stream:
+                if token is None:
+                    # The stream is opened first so nothing written during the catch-up sync is missed
+                    logging.info("No resume token stored; catching up with an incremental sync before watching.")
+                    await sim_embed.sync_vectors(raw, vectors, llm, args)
+                logging.info(f"Watching simulation.{raw.name} for answered questions.")
+                while stream.alive:
+                    changes = await asyncio.to_thread(next_changes, stream, args.max_changes, args.max_wait)
+                    if changes:
+                        unembedded = stats['unembedded']
+                        embedded, removed = await apply_changes(vectors, llm, changes, args, parser, progress, stats)
+                        lag = time.time() - min(change['clusterTime'].time for change in changes)
+                        logging.info(f"{len(changes)} changes: {embedded} questions embedded or checked, {removed} removed, "
+                                     f"lag {lag:.1f}s, {stats['written']} re-embedded since start.")
+                        if stats['unembedded'] > unembedded:
+                            logging.error("Some chunks could not be embedded; those questions keep their previous vectors "
+                                          "until they change again; run sim_embed.py to retry them.")
+                    # Saved after the batch is written, so a restart replays at most one micro-batch
+                    if stream.resume_token is not None and stream.resume_token != token:
+                        token = stream.resume_token
+                        save_resume_token(state, name, token)
+        except OperationFailure as e:
+            if e.code != CHANGE_STREAM_HISTORY_LOST:
+                raise
+            logging.warning("The stored resume token is no longer in the oplog; resyncing from the raw collection.")
+            state.delete_one({'_id': name})
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Embed answered questions as they are written, using MongoDB change streams")
+    sim_embed.add_embed_arguments(parser)
+    parser.add_argument("--max-changes", type=int, default=100, help="Change events embedded together in one micro-batch")
+    parser.add_argument("--max-wait", type=float, default=1.0, help="Seconds to wait for a micro-batch to fill")
+    parser.add_argument("--reset", action="store_true", help="Forget the stored resume token and catch up with a full incremental sync")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    sim_embed.check_environment()
+    mongo_client, raw, vectors = sim_embed.connect_to_mongodb(args.vector_collection)
+    sim_embed.ensure_indexes(vectors)
+    state = mongo_client["simulation"][STATE_COLLECTION]
+    if args.reset:
+        state.delete_one({'_id': args.vector_collection})
+
+    llm = LLMClient.from_env()
+    try:
+        asyncio.run(watch(raw, vectors, state, llm, args))
+    except KeyboardInterrupt:
+        logging.info("Embed worker stopped.")
+    finally:
+        llm.report()
+
+if __name__ == "__main__":
+    main()
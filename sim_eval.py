@@ -1,4 +1,9 @@
 import os
+import csv
+import json
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import pymongo
 from dotenv import load_dotenv
 import numpy as np
@@ -8,109 +13,283 @@ from trulens_eval.feedback import Groundedness
 from trulens_eval.app import App
 from trulens_eval.feedback.provider.openai import OpenAI as TruLensOpenAI
 
-from llama_index.vector_stores.mongodb import MongoDBAtlasVectorSearch
 from llama_index.core import VectorStoreIndex
 from llama_index.embeddings.openai import OpenAIEmbedding
 from llama_index.core import Settings
+from llama_index.core.query_engine import RetrieverQueryEngine
+from llama_index.core.schema import MetadataMode
 
-# Load environment variables
-dotenv_path = os.path.join(os.path.dirname(__file__), '.env')
-load_dotenv(dotenv_path)
-
-key = os.getenv('OPENAI_API_KEY')
-
-# Global default
-Settings.embed_model = OpenAIEmbedding(model="text-embedding-3-small", api_key=key)
-
-# MongoDB setup
-mongo_uri = os.getenv("MONGO_URI")
-mongo_client = pymongo.MongoClient(mongo_uri)
-db = mongo_client["simulation"]
-collection = db["synthdata"]
-
-# Ensure the collection is not empty
-if collection.count_documents({}) == 0:
-    raise ValueError("No documents found in MongoDB collection. Please check data population.")
-
-# Initialize vector store
-vector_store = MongoDBAtlasVectorSearch(mongo_client, db_name="simulation", collection_name="synthdata", index_name="vector_index", embedding_key="embedding")
-index = VectorStoreIndex.from_vector_store(vector_store)
-query_engine = index.as_query_engine(verbose=True)
-
-# TruLens setup
-provider = TruLensOpenAI()
-context = App.select_context(query_engine)
-
-# Define a groundedness feedback function
-grounded = Groundedness(groundedness_provider=TruLensOpenAI())
-f_groundedness = (
-    Feedback(grounded.groundedness_measure_with_cot_reasons)
-    .on(context.collect())  # Collect context chunks into a list
-    .on_output()
-    .aggregate(grounded.grounded_statements_aggregator)
-)
-
-# Question/answer relevance between overall question and answer
-f_answer_relevance = (
-    Feedback(provider.relevance)
-    .on_input_output()
-)
-
-# Question/statement relevance between question and each context chunk
-f_context_relevance = (
-    Feedback(provider.context_relevance_with_cot_reasons)
-    .on_input()
-    .on(context)
-    .aggregate(np.mean)
-)
-
-# Initialize TruLlama recorder
-tru_query_engine_recorder = TruLlama(query_engine,
-    app_id='Simulation_AI',
-    feedbacks=[f_groundedness, f_answer_relevance, f_context_relevance])
-
-# Using context manager for query execution
-with tru_query_engine_recorder as recording:
-    while True:
-        # User input for query
-        query_text = input("Enter your query (or type 'exit' to quit): ")
-        if query_text.lower() == 'exit':
-            break
-        response = query_engine.query(query_text)
-
-        # Convert any response type to string
-        response_str = str(response)
-
-        # Now handle the string response
-        print("Response:", response_str)
-        result_ids = []  # Update or process result_ids if needed based on the response_str
-
-        # Assuming the response might contain IDs or further actionable data
-        if response_str.startswith('[') and response_str.endswith(']'):
-            # Try to parse as list of IDs if response looks like a list
-            try:
-                result_ids = eval(response_str)
-            except:
-                print("Error parsing response as list of IDs.")
-        elif hasattr(response, 'result_ids'):
-            # Handling response objects with a 'result_ids' attribute
-            result_ids = [str(id) for id in response.result_ids]
-        else:
-            # Handle as plain text or log if needed
-            print("Handled as plain text response or log accordingly.")
-
-        if result_ids:
-            # Fetch full documents based on result IDs
-            full_documents = collection.find({'_id': {'$in': result_ids}})
-
-            # Process and display results
-            for doc in full_documents:
-                print("Question:", doc['metadata']['question_text'])
-                print("Answer:", doc['metadata']['answer'])
-                print("Other Metadata:", {k: v for k, v in doc['metadata'].items() if k not in ['question_text', 'answer']})
+from sim_cache import SourceCache
+from sim_lexical import build_retriever
+from sim_llm import RateLimiter
+from sim_postprocess import build_postprocessors
+from sim_sources import SOURCE_FILTER
+from sim_vectors import build_vector_store
+
+FEEDBACKS = ["groundedness", "answer_relevance", "context_relevance"]
+
+def connect():
+    # Load environment variables
+    dotenv_path = os.path.join(os.path.dirname(__file__), '.env')
+    load_dotenv(dotenv_path)
+
+    key = os.getenv('OPENAI_API_KEY')
+
+    # Global default
+    Settings.embed_model = OpenAIEmbedding(model="text-embedding-3-small", api_key=key, dimensions=int(os.getenv("SIM_EMBED_DIMENSIONS", "1536")))
+
+    # MongoDB setup
+    mongo_uri = os.getenv("MONGO_URI")
+    mongo_client = pymongo.MongoClient(mongo_uri)
+    db = mongo_client["simulation"]
+    collection = db["synthdata"]
+
+    # Ensure the collection is not empty
+    if collection.count_documents({}) == 0:
+        raise ValueError("No documents found in MongoDB collection. Please check data population.")
+    return mongo_client, collection
+
+def build_query_engine(mongo_client, collection):
+    # Initialize vector store (Atlas, or the local store when SIM_VECTOR_BACKEND=local)
+    vector_store = build_vector_store(mongo_client)
+    index = VectorStoreIndex.from_vector_store(vector_store)
+    # Vector search, or vector search fused with BM25 over synthdata when SIM_RETRIEVER=hybrid
+    # MMR diversification and context packing, unless SIM_MMR=off
+    postprocessors = build_postprocessors(vector_store)
+    query_engine = RetrieverQueryEngine.from_args(build_retriever(index, collection), node_postprocessors=postprocessors, verbose=True)
+    return query_engine, postprocessors
+
+def load_eval_set(path):
+    # Accepts a JSON list or JSON Lines file of question strings or {"question": ...} objects, a CSV
+    # file with a "question" column, or a text file with one question per line
+    extension = os.path.splitext(path)[1].lower()
+    with open(path, newline='', encoding='utf-8') as f:
+        if extension == '.csv':
+            entries = list(csv.DictReader(f))
+        elif extension == '.jsonl':
+            entries = [json.loads(line) for line in f if line.strip()]
+        elif extension == '.json':
+            entries = json.load(f)
         else:
+            entries = f.read().splitlines()
+
+    questions = []
+    for entry in entries:
+        if isinstance(entry, dict):
+            entry = entry.get('question') or entry.get('question_text') or ''
+        if entry.strip():
+            questions.append(entry.strip())
+    return questions
+
+def sample_questions(collection, size):
+    # Random answered questions from synthdata, the same documents the vector store was built from
+    cursor = collection.aggregate([
+        {'$match': SOURCE_FILTER},
+        {'$sample': {'size': size}},
+        {'$project': {'_id': 0, 'metadata.question_text': 1}}
+    ])
+    return [doc['metadata']['question_text'] for doc in cursor]
+
+def result_ids(response):
+    # The node and source document ids of the chunks behind a response, best first. Nodes keep the
+    # _id of the synthdata document they were split from as ref_doc_id.
+    return [{'node_id': node.node.node_id, 'source_id': node.node.ref_doc_id or node.node.node_id,
+             'score': node.score} for node in response.source_nodes]
+
+def percentiles(values):
+    if not values:
+        return {'p50': None, 'p95': None}
+    return {'p50': float(np.percentile(values, 50)), 'p95': float(np.percentile(values, 95))}
+
+def mean_score(values):
+    values = [value for value in values if value is not None]
+    return float(np.mean(values)) if values else None
+
+def run_query(query_engine, postprocessors, limiter, question, reserved_tokens):
+    # Waits for a slot under the requests- and tokens-per-minute limits, then answers one question
+    time.sleep(limiter.reserve(reserved_tokens))
+    started = time.perf_counter()
+    response = query_engine.query(question)
+    latency = time.perf_counter() - started
+    stats = postprocessors[0].last_stats() if postprocessors else None
+    if stats:
+        limiter.refund(reserved_tokens - stats['prompt_tokens'])
+    contexts = [node.node.get_content(metadata_mode=MetadataMode.LLM) for node in response.source_nodes]
+    return {
+        'question': question,
+        'answer': str(response),
+        'latency': latency,
+        'prompt_tokens': stats['prompt_tokens'] if stats else None,
+        'sources': result_ids(response),
+        'contexts': contexts
+    }
+
+def score_row(provider, grounded, row):
+    # The three feedback functions of the interactive recorder, called directly on the chunks the
+    # answer was synthesized from (groundedness checks the answer against all of them at once)
+    question, answer, contexts = row['question'], row['answer'], row['contexts']
+    scores = {'answer_relevance': provider.relevance(question, answer)}
+    scores['context_relevance'] = mean_score([provider.context_relevance_with_cot_reasons(question, context)[0] for context in contexts])
+    statements = grounded.groundedness_measure_with_cot_reasons("\n\n".join(contexts), answer)[0] if contexts else None
+    scores['groundedness'] = grounded.grounded_statements_aggregator(statements) if statements else None
+    return scores
+
+def evaluate_batch(query_engine, postprocessors, questions, args):
+    # Queries run --concurrency at a time under --query-rpm/--query-tpm. As each answer arrives its
+    # feedback is handed to a separate pool of --feedback-workers, paced by TruLens at --feedback-rpm,
+    # so scoring never holds up the queries behind it.
+    limiter = RateLimiter(args.query_rpm, args.query_tpm)
+    reserved_tokens = int(os.getenv("SIM_CONTEXT_BUDGET", "2000")) + 500
+    provider = TruLensOpenAI(rpm=args.feedback_rpm)
+    grounded = Groundedness(groundedness_provider=provider)
+    rows, failures = [], []
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.feedback_workers) as scorers:
+        scoring = {}
+        with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            pending = {executor.submit(run_query, query_engine, postprocessors, limiter, question, reserved_tokens): question
+                       for question in questions}
+            for future in as_completed(pending):
+                try:
+                    row = future.result()
+                except Exception as e:
+                    failures.append({'question': pending[future], 'error': str(e)})
+                    print(f"Query failed: {pending[future]!r}: {e}")
+                    continue
+                rows.append(row)
+                scoring[scorers.submit(score_row, provider, grounded, row)] = row
+                if len(rows) % 10 == 0:
+                    print(f"[{time.perf_counter() - started:.0f}s] answered {len(rows)}/{len(questions)}")
+        query_seconds = time.perf_counter() - started
+        for future in as_completed(scoring):
+            row = scoring[future]
+            try:
+                row.update(future.result())
+            except Exception as e:
+                row['feedback_error'] = str(e)
+                print(f"Feedback failed: {row['question']!r}: {e}")
+
+    latencies = [row['latency'] for row in rows]
+    summary = {
+        'questions': len(questions),
+        'answered': len(rows),
+        'failed': len(failures),
+        'query_seconds': query_seconds,
+        'total_seconds': time.perf_counter() - started,
+        'latency_seconds': percentiles(latencies),
+        'prompt_tokens': mean_score([row['prompt_tokens'] for row in rows]),
+        'scores': {name: mean_score([row.get(name) for row in rows]) for name in FEEDBACKS}
+    }
+    for row in rows:
+        del row['contexts']
+    return {'summary': summary, 'results': rows, 'failures': failures}
+
+def interactive(query_engine, postprocessors, collection):
+    sources = SourceCache.from_env(collection)
+
+    # TruLens setup
+    provider = TruLensOpenAI()
+    context = App.select_context(query_engine)
+
+    # Define a groundedness feedback function
+    grounded = Groundedness(groundedness_provider=TruLensOpenAI())
+    f_groundedness = (
+        Feedback(grounded.groundedness_measure_with_cot_reasons)
+        .on(context.collect())  # Collect context chunks into a list
+        .on_output()
+        .aggregate(grounded.grounded_statements_aggregator)
+    )
+
+    # Question/answer relevance between overall question and answer
+    f_answer_relevance = (
+        Feedback(provider.relevance)
+        .on_input_output()
+    )
+
+    # Question/statement relevance between question and each context chunk
+    f_context_relevance = (
+        Feedback(provider.context_relevance_with_cot_reasons)
+        .on_input()
+        .on(context)
+        .aggregate(np.mean)
+    )
+
+    # Initialize TruLlama recorder
+    tru_query_engine_recorder = TruLlama(query_engine,
+        app_id='Simulation_AI',
+        feedbacks=[f_groundedness, f_answer_relevance, f_context_relevance])
+
+    # Using context manager for query execution
+    with tru_query_engine_recorder as recording:
+        while True:
+            # User input for query
+            query_text = input("Enter your query (or type 'exit' to quit): ")
+            if query_text.lower() == 'exit':
+                break
+            started = time.perf_counter()
+            response = query_engine.query(query_text)
+            latency = time.perf_counter() - started
+
+            # Convert any response type to string
+            response_str = str(response)
+
+            # Now handle the string response
+            print("Response:", response_str)
+            stats = postprocessors[0].last_stats() if postprocessors else None
+            print(f"Latency: {latency:.2f}s" + (f", ~{stats['prompt_tokens']} prompt tokens from {stats['kept']} of {stats['candidates']} chunks" if stats else ""))
+
+            # Show the stored question and answer behind each chunk the answer was built from
+            results = result_ids(response)
+            documents = sources.get([result['source_id'] for result in results])
+            for result in results:
+                metadata = documents.get(result['source_id'])
+                if metadata is None:
+                    continue
+                print(f"Source {result['source_id']} (node {result['node_id']}, score {result['score']})")
+                print("Question:", metadata.get('question_text'))
+                print("Answer:", metadata.get('answer'))
+                print("Other Metadata:", {k: v for k, v in metadata.items() if k not in ['question_text', 'answer']})
             print("")
 
-from trulens_eval import Tru
-tru = Tru()
-tru.run_dashboard()
\ No newline at end of file
+    from trulens_eval import Tru
+    tru = Tru()
+    tru.run_dashboard()
+
+def parse_args():
+    # Without --eval-set or --sample, queries are read from the terminal and recorded in the TruLens dashboard
+    rpm = float(os.getenv("SIM_OPENAI_RPM", "500"))
+    parser = argparse.ArgumentParser(description="Evaluate the query engine with TruLens feedback functions")
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument("--eval-set", help="JSON, JSON Lines, CSV or text file of questions to evaluate without prompts")
+    source.add_argument("--sample", type=int, default=0, help="Evaluate this many questions sampled from synthdata without prompts")
+    parser.add_argument("--output", default="sim_eval_results.json", help="File to write the JSON scores and latencies to")
+    parser.add_argument("--concurrency", type=int, default=4, help="Queries in flight at once")
+    parser.add_argument("--feedback-workers", type=int, default=8, help="Questions scored at once")
+    parser.add_argument("--query-rpm", type=float, default=rpm / 4, help="Requests per minute for the queries (default: a quarter of SIM_OPENAI_RPM)")
+    parser.add_argument("--query-tpm", type=float, default=float(os.getenv("SIM_OPENAI_TPM", "200000")) / 4,
+                        help="Tokens per minute for the queries (default: a quarter of SIM_OPENAI_TPM)")
+    parser.add_argument("--feedback-rpm", type=int, default=int(rpm * 3 / 4), help="Requests per minute for the feedback functions (default: the rest of SIM_OPENAI_RPM)")
+    return parser.parse_args()
+
+def main():
+    mongo_client, collection = connect()
+    args = parse_args()
+    query_engine, postprocessors = build_query_engine(mongo_client, collection)
+    if not args.eval_set and not args.sample:
+        interactive(query_engine, postprocessors, collection)
+        return
+
+    questions = load_eval_set(args.eval_set) if args.eval_set else sample_questions(collection, args.sample)
+    if not questions:
+        raise SystemExit("No questions to evaluate.")
+    print(f"Evaluating {len(questions)} questions, {args.concurrency} queries and {args.feedback_workers} feedback workers at a time")
+    report = evaluate_batch(query_engine, postprocessors, questions, args)
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    summary = report['summary']
+    print(f"Answered {summary['answered']}/{summary['questions']} in {summary['query_seconds']:.1f}s, latency p50 "
+          f"{summary['latency_seconds']['p50'] or 0:.2f}s p95 {summary['latency_seconds']['p95'] or 0:.2f}s, "
+          f"scores {json.dumps(summary['scores'])}; results written to {args.output}")
+
+if __name__ == "__main__":
+    main()
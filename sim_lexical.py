@@ -0,0 +1,232 @@
+import os
+import re
+import time
+import logging
+import threading
+from collections import Counter
+import numpy as np
+from pymongo.errors import PyMongoError
+from llama_index.core.retrievers import BaseRetriever
+from llama_index.core.schema import NodeWithScore, TextNode, NodeRelationship, RelatedNodeInfo
+from sim_ann import top_k
+from sim_postprocess import mmr_enabled
+from sim_sources import SOURCE_FILTER, WATCH_PIPELINE, is_source, source_text
+
+RETRIEVERS = ["vector", "hybrid"]
+# Words, plus numbers, dates and codes with their inner punctuation ("2024-05-01", "3.5", "1,200")
+WORD_PATTERN = re.compile(r"[a-z0-9]+")
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+(?:[.,:/'-][a-z0-9]+)*")
+STOPWORDS = set("a an and are as at be by for from has have how in is it its of on or that the this to was were what when where which who why will with".split())
+
+def tokenize(text):
+    # Every word, plus each compound token whole, so "2024-05-01" matches queries for it and for "2024"
+    text = text.lower()
+    tokens = [word for word in WORD_PATTERN.findall(text) if word not in STOPWORDS]
+    tokens.extend(token for token in TOKEN_PATTERN.findall(text) if not token.isalnum())
+    return tokens
+
+
+# Okapi BM25 over the question and answer text of every answered question, held in memory. Each
+# term's postings are NumPy arrays of rows and term frequencies with spare capacity. Adding a
+# document only appends to short lists of its own terms, which are moved into the arrays when a
+# query next uses the term, so a query costs one vectorized pass per query term plus an
+# argpartition however often the index changes. Updated documents get a new row and their old row
+# is tombstoned; a term's arrays are compacted once most of their entries are tombstones.
+class LexicalIndex:
+    def __init__(self, k1=1.2, b=0.75):
+        self.k1 = k1
+        self.b = b
+        # term -> [rows, counts, entries used, tombstoned entries, [(row, count) not yet in the arrays]]
+        self.postings = {}
+        self.rows = {}
+        self.sources = []
+        self.metadata = []
+        self.terms = []
+        self.lengths = np.zeros(1024, dtype=np.float32)
+        self.alive = np.zeros(1024, dtype=bool)
+        self.live = 0
+        self.total_length = 0
+        self.norm = None
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_collection(cls, raw, follow=False, chunk_size=1000):
+        # Loads every answered question from the raw collection. With follow=True the change stream is
+        # opened before the load, so nothing written during it is missed, and then applied in a daemon thread.
+        index = cls()
+        stream = None
+        if follow:
+            try:
+                stream = raw.watch(WATCH_PIPELINE, full_document='updateLookup')
+            except PyMongoError as e:
+                logging.warning(f"Cannot watch {raw.name} ({e}); the lexical index will not see new answers until restarted.")
+        started = time.perf_counter()
+        for doc in raw.find(SOURCE_FILTER, {'metadata': 1}, batch_size=chunk_size):
+            index.add(str(doc['_id']), doc['metadata'])
+        logging.info(f"Lexical index built over {len(index)} answered questions in {time.perf_counter() - started:.1f}s.")
+        if stream is not None:
+            threading.Thread(target=index.follow, args=(stream,), daemon=True).start()
+        return index
+
+    def __len__(self):
+        return self.live
+
+    def add(self, source_id, metadata):
+        counts = Counter(tokenize(source_text(metadata)))
+        with self.lock:
+            self._remove(source_id)
+            row = len(self.sources)
+            if row == len(self.alive):
+                self.alive = np.concatenate([self.alive, np.zeros(row, dtype=bool)])
+                self.lengths = np.concatenate([self.lengths, np.zeros(row, dtype=np.float32)])
+            self.rows[source_id] = row
+            self.sources.append(source_id)
+            self.metadata.append(metadata)
+            self.terms.append(counts)
+            length = counts.total()
+            self.alive[row] = True
+            self.lengths[row] = length
+            self.live += 1
+            self.total_length += length
+            self.norm = None
+            postings = self.postings
+            for term, count in counts.items():
+                entry = postings.get(term)
+                if entry is None:
+                    entry = postings[term] = [None, None, 0, 0, []]
+                entry[4].append((row, count))
+
+    def remove(self, source_id):
+        with self.lock:
+            self._remove(source_id)
+
+    def apply_change(self, change):
+        source_id = str(change['documentKey']['_id'])
+        doc = change.get('fullDocument')
+        if doc is not None and is_source(doc):
+            self.add(source_id, doc['metadata'])
+        else:
+            self.remove(source_id)
+
+    def follow(self, stream):
+        try:
+            with stream:
+                for change in stream:
+                    self.apply_change(change)
+        except PyMongoError as e:
+            logging.error(f"Lexical index stopped following changes: {e}")
+
+    def search(self, query, k):
+        # Returns [(source_id, metadata, score)] for the k best matching answered questions
+        terms = set(tokenize(query))
+        with self.lock:
+            if not self.live or not terms:
+                return []
+            count = len(self.sources)
+            if self.norm is None:
+                # Length normalization of every row, one vectorized pass after the index changes
+                self.norm = self.k1 * (1 - self.b + self.b * self.lengths[:count] / max(1.0, self.total_length / self.live))
+            norm = self.norm
+            scores = np.zeros(count, dtype=np.float32)
+            for term in terms:
+                entry = self.postings.get(term)
+                if entry is None:
+                    continue
+                rows, counts = self._arrays(entry)
+                frequency = entry[2] - entry[3]
+                idf = np.log(1 + (self.live - frequency + 0.5) / (frequency + 0.5))
+                scores[rows] += idf * counts * (self.k1 + 1) / (counts + norm[rows])
+            if self.live < count:
+                scores[~self.alive[:count]] = 0
+            best = [row for row in top_k(scores, k) if scores[row] > 0]
+            return [(self.sources[row], self.metadata[row], float(scores[row])) for row in best]
+
+    def _remove(self, source_id):
+        row = self.rows.pop(source_id, None)
+        if row is None:
+            return
+        self.alive[row] = False
+        for term in self.terms[row]:
+            entry = self.postings[term]
+            entry[3] += 1
+            if entry[3] == entry[2] + len(entry[4]):
+                del self.postings[term]
+            elif entry[3] * 2 > entry[2] + len(entry[4]):
+                rows, counts = self._arrays(entry)
+                keep = self.alive[rows]
+                entry[0], entry[1] = rows[keep], counts[keep]
+                entry[2], entry[3] = len(entry[0]), 0
+        self.live -= 1
+        self.total_length -= int(self.lengths[row])
+        self.norm = None
+        self.terms[row], self.metadata[row] = {}, None
+
+    def _arrays(self, entry):
+        # Moves the term's appended postings into its arrays, doubling their capacity as needed
+        pending = entry[4]
+        if pending:
+            used, needed = entry[2], entry[2] + len(pending)
+            if entry[0] is None or needed > len(entry[0]):
+                capacity = max(needed, 2 * used, 4)
+                rows, counts = np.empty(capacity, dtype=np.int64), np.empty(capacity, dtype=np.float32)
+                if used:
+                    rows[:used], counts[:used] = entry[0][:used], entry[1][:used]
+                entry[0], entry[1] = rows, counts
+            entry[0][used:needed], entry[1][used:needed] = zip(*pending)
+            entry[2] = needed
+            pending.clear()
+        return entry[0][:entry[2]], entry[1][:entry[2]]
+
+
+# Fuses dense vector results with BM25 results by reciprocal rank fusion: each result scores
+# sum(1 / (rrf_k + rank)) over the lists it appears in. Results are matched on their source
+# question, so a question found by both retrievers counts once and keeps its vector node. The
+# vector list is ranked by source too: only a question's best chunk counts, at its rank among the
+# distinct questions, so a long answer split into several chunks gets no extra votes.
+class HybridRetriever(BaseRetriever):
+    def __init__(self, vector_retriever, lexical_index, similarity_top_k=2, candidates=20, rrf_k=60, **kwargs):
+        self.vector_retriever = vector_retriever
+        self.lexical_index = lexical_index
+        self.similarity_top_k = similarity_top_k
+        self.candidates = candidates
+        self.rrf_k = rrf_k
+        super().__init__(**kwargs)
+
+    def _retrieve(self, query_bundle):
+        fused, scores = {}, {}
+        for result in self.vector_retriever.retrieve(query_bundle):
+            key = result.node.ref_doc_id or result.node.node_id
+            if key not in fused:
+                fused[key] = result.node
+                scores[key] = 1.0 / (self.rrf_k + len(fused))
+        for rank, (source_id, metadata, _) in enumerate(self.lexical_index.search(query_bundle.query_str, self.candidates)):
+            fused.setdefault(source_id, self._node(source_id, metadata))
+            scores[source_id] = scores.get(source_id, 0.0) + 1.0 / (self.rrf_k + rank + 1)
+        best = sorted(scores, key=scores.get, reverse=True)[:self.similarity_top_k]
+        return [NodeWithScore(node=fused[key], score=scores[key]) for key in best]
+
+    def _node(self, source_id, metadata):
+        # Laid out like the nodes sim_embed.py writes, with the source _id as ref_doc_id
+        return TextNode(
+            id_=f"{source_id}-0",
+            text=source_text(metadata),
+            metadata=dict(metadata),
+            excluded_llm_metadata_keys=["answer"],
+            excluded_embed_metadata_keys=["answer"],
+            relationships={NodeRelationship.SOURCE: RelatedNodeInfo(node_id=source_id)}
+        )
+
+def build_retriever(index, raw, similarity_top_k=None, follow=False):
+    # SIM_RETRIEVER=vector (default) searches the vector store only; hybrid fuses it with a BM25 index
+    # over the raw collection, which follows the collection's change stream when follow=True.
+    # SIM_RETRIEVER_TOP_K chunks are retrieved: by default 8 for MMR to choose from, or with SIM_MMR=off
+    # the 2 that go straight to synthesis.
+    mode = os.getenv("SIM_RETRIEVER", "vector")
+    similarity_top_k = similarity_top_k or int(os.getenv("SIM_RETRIEVER_TOP_K", "8" if mmr_enabled() else "2"))
+    if mode not in RETRIEVERS:
+        raise ValueError(f"Unknown retriever '{mode}', expected one of {RETRIEVERS}")
+    if mode == "vector":
+        return index.as_retriever(similarity_top_k=similarity_top_k)
+    candidates = int(os.getenv("SIM_HYBRID_CANDIDATES", "20"))
+    return HybridRetriever(index.as_retriever(similarity_top_k=candidates), LexicalIndex.from_collection(raw, follow),
+                           similarity_top_k, candidates, int(os.getenv("SIM_RRF_K", "60")))
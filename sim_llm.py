@@ -0,0 +1,331 @@
+import os
+import time
+import random
+import asyncio
+import threading
+from contextlib import contextmanager, asynccontextmanager
+import openai
+from openai import OpenAI, AsyncOpenAI
+from sim_cache import LLMCache
+from sim_context import count_message_tokens, count_tokens
+
+# Completion tokens reserved against the TPM budget when a request does not set max_tokens
+DEFAULT_COMPLETION_TOKENS = 1000
+
+
+# Requests-per-minute and tokens-per-minute token buckets. reserve() takes the capacity up front,
+# letting the balance go negative, and returns how long the caller has to wait before sending,
+# so the same limiter serves threads (time.sleep) and coroutines (asyncio.sleep). The rate backs
+# off on 429s and creeps back to the configured limit while calls keep succeeding.
+class RateLimiter:
+    def __init__(self, requests_per_minute, tokens_per_minute):
+        self.limits = (float(requests_per_minute), float(tokens_per_minute))
+        self.scale = 1.0
+        self.available = list(self.limits)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self, tokens):
+        with self.lock:
+            self._refill()
+            amounts = (1.0, min(float(tokens), self.limits[1]))
+            wait = 0.0
+            for i, amount in enumerate(amounts):
+                self.available[i] -= amount
+                if self.available[i] < 0:
+                    wait = max(wait, -self.available[i] / self._per_second(i))
+            return wait
+
+    def refund(self, tokens):
+        # Corrects the token reservation once the real usage is known (negative to charge more)
+        with self.lock:
+            self.available[1] = min(self.limits[1], self.available[1] + tokens)
+
+    def throttle(self):
+        with self.lock:
+            self.scale = max(0.1, self.scale * 0.8)
+
+    def recover(self):
+        with self.lock:
+            self.scale = min(1.0, self.scale * 1.01)
+
+    def _per_second(self, i):
+        return self.limits[i] * self.scale / 60.0
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed, self.updated = now - self.updated, now
+        for i in range(2):
+            self.available[i] = min(self.limits[i], self.available[i] + elapsed * self._per_second(i))
+
+
+# Opens after `failure_threshold` consecutive retryable failures; while open every caller in the
+# process waits out the cooldown instead of hammering a struggling API
+class CircuitBreaker:
+    def __init__(self, failure_threshold=5, cooldown=30.0):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+        self.lock = threading.Lock()
+
+    def wait_time(self):
+        return max(0.0, self.open_until - time.monotonic())
+
+    def record_success(self):
+        with self.lock:
+            self.consecutive_failures = 0
+
+    def record_failure(self):
+        with self.lock:
+            self.consecutive_failures += 1
+            if self.consecutive_failures >= self.failure_threshold and self.wait_time() == 0:
+                self.open_until = time.monotonic() + self.cooldown
+                print(f"Circuit open after {self.consecutive_failures} consecutive failures, pausing OpenAI calls for {self.cooldown:.0f}s")
+
+def is_retryable(error):
+    if isinstance(error, openai.RateLimitError):
+        # An exhausted quota will not recover by waiting
+        return getattr(error, "code", None) != "insufficient_quota"
+    if isinstance(error, (openai.APIConnectionError, openai.InternalServerError)):
+        return True
+    return isinstance(error, openai.APIStatusError) and error.status_code in (408, 409)
+
+def retry_after_seconds(error):
+    response = getattr(error, "response", None)
+    headers = response.headers if response is not None else {}
+    for header, scale in (("retry-after-ms", 0.001), ("retry-after", 1.0)):
+        try:
+            return float(headers.get(header)) * scale
+        except (TypeError, ValueError):
+            continue
+    return None
+
+
+# Shared wrapper for every OpenAI chat and embedding call: response cache, optional cross-process
+# request gate, per-model rate limiting, retries with jittered exponential backoff that honour the
+# server's retry-after headers, and a circuit breaker. Failures surface as exceptions once retries
+# are exhausted, so callers never mistake a rate-limited call for an empty answer.
+class LLMClient:
+    def __init__(self, api_key=None, requests_per_minute=500, tokens_per_minute=200000, max_retries=6,
+                 base_delay=1.0, max_delay=60.0, cache=None, gate=None):
+        # The SDK's own retries are disabled so backoff happens in one place
+        self.client = OpenAI(api_key=api_key, max_retries=0)
+        self.api_key = api_key
+        self._async_client = None
+        self._async_loop = None
+        self.configured_limits = (requests_per_minute, tokens_per_minute)
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.cache = cache
+        self.gate = gate
+        self.breaker = CircuitBreaker()
+        self.limiters = {}
+        self.limiters_lock = threading.Lock()
+        self.stats = {"requests": 0, "retries": 0, "rate_limited": 0, "failures": 0}
+
+    @classmethod
+    def from_env(cls):
+        # SIM_OPENAI_RPM and SIM_OPENAI_TPM are the account limits applied to each model
+        return cls(
+            api_key=os.getenv('OPENAI_API_KEY'),
+            requests_per_minute=float(os.getenv("SIM_OPENAI_RPM", "500")),
+            tokens_per_minute=float(os.getenv("SIM_OPENAI_TPM", "200000")),
+            max_retries=int(os.getenv("SIM_OPENAI_MAX_RETRIES", "6")),
+            cache=LLMCache.from_env()
+        )
+
+    @property
+    def async_client(self):
+        # AsyncOpenAI pools connections on the event loop that opened them, so each event loop (every
+        # asyncio.run) gets a client of its own instead of one whose connections belong to a closed loop
+        loop = asyncio.get_running_loop()
+        if self._async_loop is not loop:
+            self._async_client = AsyncOpenAI(api_key=self.api_key, max_retries=0)
+            self._async_loop = loop
+        return self._async_client
+
+    async def aclose(self):
+        # Closes the running event loop's client; await it before the loop finishes
+        if self._async_client is not None and self._async_loop is asyncio.get_running_loop():
+            await self._async_client.close()
+        self._async_client, self._async_loop = None, None
+
+    def set_limit_share(self, share):
+        # Gives each of several processes sharing one account its share of the configured limits
+        self.requests_per_minute = self.configured_limits[0] * share
+        self.tokens_per_minute = self.configured_limits[1] * share
+        with self.limiters_lock:
+            self.limiters = {}
+
+    def chat(self, model, messages, **params):
+        # Returns (content, prompt_tokens); prompt_tokens is None when it is not known
+        key = LLMCache.key(model, messages, **params) if self.cache else None
+        cached = self.cache.get(key) if key else None
+        if cached is not None:
+            return cached[0], cached[1]
+        estimate = self._estimate(messages, params)
+        response = self._call(model, estimate, lambda: self.client.chat.completions.create(model=model, messages=messages, **params))
+        return self._finish(key, model, estimate, response)
+
+    async def achat(self, model, messages, **params):
+        key = LLMCache.key(model, messages, **params) if self.cache else None
+        cached = self.cache.get(key) if key else None
+        if cached is not None:
+            return cached[0], cached[1]
+        estimate = self._estimate(messages, params)
+        response = await self._acall(model, estimate, lambda: self.async_client.chat.completions.create(model=model, messages=messages, **params))
+        return self._finish(key, model, estimate, response)
+
+    async def astream(self, model, messages, **params):
+        # Yields completion text as it streams; a cached completion is replayed as a single chunk.
+        # Failures before the first chunk are retried, later ones are raised to the caller. The request
+        # slot is held until the stream ends, so callers should not wait on other work between chunks.
+        key = LLMCache.key(model, messages, **params) if self.cache else None
+        cached = self.cache.get(key) if key else None
+        if cached is not None:
+            yield cached[0]
+            return
+        estimate = self._estimate(messages, params)
+        limiter = self._limiter(model)
+        for attempt in range(self.max_retries + 1):
+            await asyncio.sleep(max(self.breaker.wait_time(), limiter.reserve(estimate)))
+            chunks = []
+            try:
+                async with self._async_slot():
+                    self.stats["requests"] += 1
+                    stream = await self.async_client.chat.completions.create(model=model, messages=messages, stream=True, **params)
+                    async for chunk in stream:
+                        if chunk.choices and chunk.choices[0].delta.content:
+                            chunks.append(chunk.choices[0].delta.content)
+                            yield chunk.choices[0].delta.content
+            except Exception as e:
+                delay = self._retry_delay(e, attempt, limiter, retryable=not chunks)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                continue
+            self._succeeded(limiter)
+            content = "".join(chunks)
+            limiter.refund(estimate - count_tokens(content) - count_message_tokens(messages))
+            if key:
+                self.cache.put(key, model, content)
+            return
+
+    def embed(self, model, inputs, **params):
+        estimate = sum(count_tokens(text) for text in inputs)
+        response = self._call(model, estimate, lambda: self.client.embeddings.create(model=model, input=inputs, **params))
+        return [item.embedding for item in response.data]
+
+    async def aembed(self, model, inputs, **params):
+        estimate = sum(count_tokens(text) for text in inputs)
+        response = await self._acall(model, estimate, lambda: self.async_client.embeddings.create(model=model, input=inputs, **params))
+        return [item.embedding for item in response.data]
+
+    def report(self):
+        print(f"OpenAI calls: {self.stats['requests']} requests, {self.stats['retries']} retries, "
+              f"{self.stats['rate_limited']} rate limited, {self.stats['failures']} failed after retries")
+        if self.cache:
+            self.cache.report()
+
+    def _call(self, model, estimate, send):
+        limiter = self._limiter(model)
+        for attempt in range(self.max_retries + 1):
+            time.sleep(max(self.breaker.wait_time(), limiter.reserve(estimate)))
+            try:
+                with self._slot():
+                    self.stats["requests"] += 1
+                    response = send()
+            except Exception as e:
+                delay = self._retry_delay(e, attempt, limiter)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                continue
+            self._succeeded(limiter)
+            return response
+
+    async def _acall(self, model, estimate, send):
+        limiter = self._limiter(model)
+        for attempt in range(self.max_retries + 1):
+            await asyncio.sleep(max(self.breaker.wait_time(), limiter.reserve(estimate)))
+            try:
+                async with self._async_slot():
+                    self.stats["requests"] += 1
+                    response = await send()
+            except Exception as e:
+                delay = self._retry_delay(e, attempt, limiter)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                continue
+            self._succeeded(limiter)
+            return response
+
+    def _retry_delay(self, error, attempt, limiter, retryable=True):
+        # Returns how long to wait before the next attempt, or None when the error should be raised
+        if not retryable or not is_retryable(error):
+            return None
+        self.breaker.record_failure()
+        if isinstance(error, openai.RateLimitError):
+            self.stats["rate_limited"] += 1
+            limiter.throttle()
+        if attempt >= self.max_retries:
+            self.stats["failures"] += 1
+            return None
+        self.stats["retries"] += 1
+        backoff = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        retry_after = retry_after_seconds(error)
+        delay = max(backoff, retry_after + random.uniform(0, self.base_delay)) if retry_after is not None else backoff
+        print(f"OpenAI call failed ({type(error).__name__}), retry {attempt + 1}/{self.max_retries} in {delay:.1f}s")
+        return delay
+
+    def _succeeded(self, limiter):
+        self.breaker.record_success()
+        limiter.recover()
+
+    def _finish(self, key, model, estimate, response):
+        content = response.choices[0].message.content
+        usage = response.usage
+        prompt_tokens = usage.prompt_tokens if usage else None
+        if usage:
+            self._limiter(model).refund(estimate - usage.total_tokens)
+        if key:
+            self.cache.put(key, model, content, prompt_tokens)
+        return content, prompt_tokens
+
+    def _estimate(self, messages, params):
+        return count_message_tokens(messages) + params.get("max_tokens", DEFAULT_COMPLETION_TOKENS)
+
+    def _limiter(self, model):
+        with self.limiters_lock:
+            if model not in self.limiters:
+                self.limiters[model] = RateLimiter(self.requests_per_minute, self.tokens_per_minute)
+            return self.limiters[model]
+
+    @contextmanager
+    def _slot(self):
+        if self.gate is None:
+            yield
+            return
+        self.gate.acquire()
+        try:
+            yield
+        finally:
+            self.gate.release()
+
+    @asynccontextmanager
+    async def _async_slot(self):
+        if self.gate is None:
+            yield
+            return
+        # Poll rather than block so waiting coroutines never tie up executor threads
+        while not self.gate.acquire(False):
+            await asyncio.sleep(0.05)
+        try:
+            yield
+        finally:
+            self.gate.release()
@@ -0,0 +1,99 @@
+import os
+import time
+import logging
+import threading
+import numpy as np
+from llama_index.core import Settings
+from llama_index.core.bridge.pydantic import PrivateAttr
+from llama_index.core.postprocessor.types import BaseNodePostprocessor
+from llama_index.core.prompts.default_prompts import DEFAULT_TEXT_QA_PROMPT
+from llama_index.core.schema import MetadataMode
+from sim_context import count_tokens, normalize_rows
+from sim_vectors import node_embeddings
+
+
+# Picks a diverse subset of the retrieved chunks and packs it into a fixed context budget before
+# synthesis. Maximal marginal relevance takes, one at a time, the chunk maximizing
+# lambda * similarity to the query - (1 - lambda) * highest similarity to a chunk already taken,
+# over one similarity matrix of the candidates' stored embeddings. The picks are then added in
+# that order while their text fits in `token_budget` tokens (the first one always goes in).
+# Stats of the last query are kept per thread for the caller to report.
+class MMRPostprocessor(BaseNodePostprocessor):
+    top_n: int = 3
+    mmr_lambda: float = 0.5
+    token_budget: int = 2000
+
+    _vector_store = PrivateAttr()
+    _stats = PrivateAttr()
+
+    def __init__(self, vector_store=None, **kwargs):
+        super().__init__(**kwargs)
+        self._vector_store = vector_store
+        self._stats = threading.local()
+
+    @classmethod
+    def class_name(cls):
+        return "MMRPostprocessor"
+
+    def last_stats(self):
+        return getattr(self._stats, "value", None)
+
+    def _postprocess_nodes(self, nodes, query_bundle=None):
+        started = time.perf_counter()
+        selected = self._mmr(nodes, query_bundle) if len(nodes) > 1 else list(nodes)
+        packed, context_tokens = [], 0
+        for node in selected:
+            tokens = count_tokens(node.node.get_content(metadata_mode=MetadataMode.LLM))
+            if packed and context_tokens + tokens > self.token_budget:
+                continue
+            packed.append(node)
+            context_tokens += tokens
+        # Prompt of a single compact synthesis call: the QA template around the packed context
+        context = "\n\n".join(node.node.get_content(metadata_mode=MetadataMode.LLM) for node in packed)
+        prompt_tokens = count_tokens(DEFAULT_TEXT_QA_PROMPT.format(context_str=context, query_str=query_bundle.query_str if query_bundle else ""))
+        self._stats.value = {"candidates": len(nodes), "kept": len(packed), "context_tokens": context_tokens,
+                             "prompt_tokens": prompt_tokens, "postprocess_ms": (time.perf_counter() - started) * 1000}
+        logging.info(f"Context: {len(packed)} of {len(nodes)} chunks, {context_tokens} context tokens, "
+                     f"~{prompt_tokens} prompt tokens, postprocessed in {self._stats.value['postprocess_ms']:.1f}ms")
+        return packed
+
+    def _mmr(self, nodes, query_bundle):
+        vectors = self._embeddings(nodes)
+        query = query_bundle.embedding if query_bundle is not None and query_bundle.embedding else \
+            Settings.embed_model.get_query_embedding(query_bundle.query_str)
+        vectors = normalize_rows(np.asarray(vectors, dtype=np.float32))
+        relevance = vectors @ normalize_rows(np.asarray([query], dtype=np.float32))[0]
+        similarity = vectors @ vectors.T
+        redundancy = np.zeros(len(nodes), dtype=np.float32)
+        available = np.ones(len(nodes), dtype=bool)
+        picks = []
+        for _ in range(min(self.top_n, len(nodes))):
+            scores = self.mmr_lambda * relevance - (1 - self.mmr_lambda) * redundancy
+            best = int(np.argmax(np.where(available, scores, -np.inf)))
+            picks.append(best)
+            available[best] = False
+            redundancy = np.maximum(redundancy, similarity[:, best])
+        return [nodes[i] for i in picks]
+
+    def _embeddings(self, nodes):
+        # Stored vectors where the store has them; anything else (e.g. BM25-only hits) is embedded
+        ids = [node.node.node_id for node in nodes]
+        stored = node_embeddings(self._vector_store, ids) if self._vector_store is not None else {}
+        missing = [i for i, node_id in enumerate(ids) if node_id not in stored]
+        if missing:
+            embedded = Settings.embed_model.get_text_embedding_batch(
+                [nodes[i].node.get_content(metadata_mode=MetadataMode.EMBED) for i in missing])
+            stored.update({ids[i]: vector for i, vector in zip(missing, embedded)})
+        return [stored[node_id] for node_id in ids]
+
+def mmr_enabled():
+    return os.getenv("SIM_MMR", "on") != "off"
+
+def build_postprocessors(vector_store):
+    # SIM_MMR=on (default) diversifies the SIM_RETRIEVER_TOP_K retrieved chunks down to SIM_MMR_TOP_N with
+    # SIM_MMR_LAMBDA and packs them into SIM_CONTEXT_BUDGET tokens; off passes the retrieved chunks through
+    if not mmr_enabled():
+        return []
+    return [MMRPostprocessor(vector_store, top_n=int(os.getenv("SIM_MMR_TOP_N", "3")),
+                             mmr_lambda=float(os.getenv("SIM_MMR_LAMBDA", "0.5")),
+                             token_budget=int(os.getenv("SIM_CONTEXT_BUDGET", "2000")))]
@@ -0,0 +1,107 @@
+import numpy as np
+from bson.binary import Binary
+
+# How sim_embed.py stores each embedding in MongoDB. array is the original BSON array of doubles;
+# float32 packs it into a BSON binary vector (subtype 9: a dtype byte, a padding byte, the data).
+# Lossy codes are built by the local store from the float32 rows (QUANTIZATIONS), not stored.
+EMBEDDING_ENCODINGS = ["array", "float32"]
+# Compact codes the local store can run its coarse search on before rescoring at full precision
+QUANTIZATIONS = ["none", "float32", "int8", "binary"]
+VECTOR_SUBTYPE = 9
+VECTOR_DTYPES = {"float32": 0x27, "int8": 0x03, "binary": 0x10}
+# Set bits per byte value, for Hamming distances over packed binary codes
+POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint16)
+
+def normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+def int8_codes(vectors):
+    # Scalar quantization with one scale per vector. Cosine similarity ignores that scale, so the
+    # codes can be compared without it.
+    vectors = np.asarray(vectors, dtype=np.float32)
+    scale = np.abs(vectors).max(axis=-1, keepdims=True)
+    scale[scale == 0] = 1.0
+    return np.round(vectors / scale * 127).astype(np.int8)
+
+def binary_codes(vectors):
+    # One sign bit per dimension, packed eight to a byte
+    return np.packbits(np.asarray(vectors) > 0, axis=-1)
+
+def encode_embedding(embedding, encoding):
+    if encoding == "array":
+        return embedding
+    if encoding != "float32":
+        raise ValueError(f"Unknown embedding encoding '{encoding}', expected one of {EMBEDDING_ENCODINGS}")
+    data = np.asarray(embedding, dtype="<f4").tobytes()
+    return Binary(bytes([VECTOR_DTYPES["float32"], 0]) + data, VECTOR_SUBTYPE)
+
+def decode_embedding(value):
+    # Float32 vector from any BSON vector. The int8 and binary dtypes are still read for nodes written
+    # by older versions (which kept a float32 copy in embedding_full): int8 codes come back scaled,
+    # binary codes as +1/-1
+    if not isinstance(value, bytes):
+        return np.asarray(value, dtype=np.float32)
+    dtype, padding, data = value[0], value[1], value[2:]
+    if dtype == VECTOR_DTYPES["float32"]:
+        return np.frombuffer(data, dtype="<f4").astype(np.float32)
+    if dtype == VECTOR_DTYPES["int8"]:
+        return np.frombuffer(data, dtype=np.int8).astype(np.float32)
+    if dtype == VECTOR_DTYPES["binary"]:
+        bits = np.unpackbits(np.frombuffer(data, dtype=np.uint8))[:len(data) * 8 - padding]
+        return bits.astype(np.float32) * 2 - 1
+    raise ValueError(f"Unknown BSON vector dtype {dtype:#x}")
+
+
+# In-memory codes for the coarse stage of a two-stage search. Only the first `dimensions` columns
+# are kept (text-embedding-3 vectors are Matryoshka-trained, so a prefix is still a usable
+# embedding), as float32, int8 or sign bits. scores() ranks every row by estimated cosine
+# similarity; the store then rescores the best candidates against the full-precision matrix.
+class QuantizedCodes:
+    def __init__(self, kind, dimensions, codes, norms=None):
+        self.kind = kind
+        self.dimensions = dimensions
+        self.codes = codes
+        self.norms = norms
+
+    @classmethod
+    def build(cls, kind, matrix, dimensions=0, chunk_size=65536):
+        if kind not in QUANTIZATIONS[1:]:
+            raise ValueError(f"Unknown quantization '{kind}', expected one of {QUANTIZATIONS[1:]}")
+        dimensions = min(dimensions or matrix.shape[1], matrix.shape[1])
+        codes = cls(kind, dimensions, None)
+        # Encoded a chunk at a time so a memory-mapped matrix is never read whole
+        for start in range(0, len(matrix), chunk_size):
+            codes.add(matrix[start:start + chunk_size])
+        if codes.codes is None:
+            codes.add(np.empty((0, matrix.shape[1]), dtype=np.float32))
+        return codes
+
+    def add(self, vectors):
+        prefix = np.asarray(vectors, dtype=np.float32)[:, :self.dimensions]
+        if self.kind == "binary":
+            codes, norms = binary_codes(prefix), None
+        else:
+            codes = prefix if self.kind == "float32" else int8_codes(prefix)
+            norms = np.linalg.norm(codes.astype(np.float32), axis=1)
+            norms[norms == 0] = 1.0
+        self.codes = codes if self.codes is None else np.concatenate([self.codes, codes])
+        if norms is not None:
+            self.norms = norms if self.norms is None else np.concatenate([self.norms, norms])
+
+    def scores(self, query, chunk_size=65536):
+        prefix = np.asarray(query, dtype=np.float32)[:self.dimensions]
+        if self.kind == "binary":
+            # Matching bits minus differing bits, the dot product of the +1/-1 vectors
+            packed = binary_codes(prefix)
+            distances = np.concatenate([POPCOUNT[np.bitwise_xor(self.codes[start:start + chunk_size], packed)].sum(axis=1)
+                                        for start in range(0, len(self.codes), chunk_size)]) if len(self.codes) else np.empty(0)
+            return (self.dimensions - 2 * distances.astype(np.float32)) / self.dimensions
+        scores = np.concatenate([self.codes[start:start + chunk_size].astype(np.float32) @ prefix
+                                 for start in range(0, len(self.codes), chunk_size)]) if len(self.codes) else np.empty(0, dtype=np.float32)
+        return scores / self.norms
+
+    def bytes_per_vector(self):
+        return self.codes.shape[1] * self.codes.itemsize + (4 if self.norms is not None else 0)
@@ -1,14 +1,18 @@
 import os
+import argparse
+import uuid
+from datetime import datetime, timezone
 from dotenv import load_dotenv
-from pymongo import MongoClient
-from openai import OpenAI
+from pymongo import MongoClient, UpdateOne
 import json
+from sim_llm import LLMClient
+from sim_store import ensure_unique_index
 
 # Load environment variables
 load_dotenv()
 
-# Setup OpenAI client
-openai_client = OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
+# Setup OpenAI client: rate limited, retried and optionally cached (see sim_llm.py)
+llm = LLMClient.from_env()
 
 # MongoDB setup
 def connect_to_mongodb():
@@ -19,19 +23,59 @@ def connect_to_mongodb():
 
 def clear_collection(collection):
     collection.delete_many({})
+    runs_collection(collection).delete_many({})
     print("Collection cleared successfully.")
 
+def runs_collection(collection):
+    return collection.database["runs"]
+
+def ensure_indexes(collection):
+    # One question per (run, id). The filter only covers documents that have an id, so questions written
+    # by sims_start.py (keyed on metadata.number) are left out
+    ensure_unique_index(collection, [("run_id", 1), ("id", 1)], {"run_id": {"$exists": True}, "id": {"$exists": True}})
+
+def create_run(collection, scenario, num_iterations):
+    run = {
+        '_id': datetime.now().strftime("%Y%m%d-%H%M%S-") + uuid.uuid4().hex[:6],
+        'scenario': scenario,
+        'iterations': num_iterations,
+        'completed_iterations': 0,
+        'created_at': datetime.now(timezone.utc),
+        'producer': 'sim_questions'
+    }
+    runs_collection(collection).insert_one(run)
+    print(f"Started run {run['_id']}")
+    return run
+
+def load_run(collection, run_id):
+    run = runs_collection(collection).find_one({'_id': run_id})
+    if not run:
+        raise ValueError(f"No run found with id {run_id}")
+    return run
+
+def mark_iteration_complete(collection, run):
+    run['completed_iterations'] += 1
+    runs_collection(collection).update_one({'_id': run['_id']}, {'$inc': {'completed_iterations': 1}})
+
 def store_questions(collection, questions):
+    # Returns False when the write failed, so the set is not counted as complete
     if questions:  # Check if the questions list is not empty
         try:
-            collection.insert_many(questions)
+            # Upsert on (run_id, id) so a retried batch never creates duplicates
+            collection.bulk_write([
+                UpdateOne({'run_id': q['run_id'], 'id': q['id']}, {'$setOnInsert': {'question_text': q['question_text'], 'answered': False}}, upsert=True)
+                for q in questions
+            ], ordered=False)
             print("Questions stored successfully.")
         except Exception as e:
-            print(f"Error storing questions: {e}")
+            print(f"ERROR: storing questions failed: {e}")
+            return False
     else:
         print("No questions to store.")
+    return True
 
 def generate_questions(scenario, previous_questions):
+    # Returns None when generation failed, so the set stays pending for --resume
     prior_context = " ".join([q['question_text'] for q in previous_questions]) if previous_questions else ""
     user_prompt = (f"Considering these previous questions: {prior_context} Now, generate a list of 10 new questions about the consequences of {scenario}, "
                    "focusing on both immediate and long-term impacts. Each question should be a JSON object with the key 'question_text'.") if prior_context else (
@@ -44,39 +88,60 @@ def generate_questions(scenario, previous_questions):
     ]
 
     try:
-        response = openai_client.chat.completions.create(
+        content, _ = llm.chat(
             model="gpt-4o",
             messages=messages,
             response_format={"type": "json_object"}
         )
         # Correctly accessing the response content
-        generated_questions = json.loads(response.choices[0].message.content).get('questions', [])
+        generated_questions = json.loads(content).get('questions', [])
         print("Generated questions JSON:", generated_questions)
         return generated_questions
     except Exception as e:
         print(f"Failed to generate questions: {e}")
-        return []
+        return None
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Simulation Question Generator")
+    parser.add_argument("--resume", metavar="RUN_ID", help="Continue generating the remaining question sets of an earlier run")
+    parser.add_argument("--clear", action="store_true", help="Delete every stored question and run before starting a new run")
+    return parser.parse_args()
 
 def main():
+    args = parse_args()
     print("Welcome to the Simulation Question Generator!")
-    scenario = input("Enter the scenario you want to explore: ")
-    num_iterations = int(input("How many sets of 10 questions do you want to generate? "))
-    
     collection = connect_to_mongodb()
-    clear_collection(collection)
-    
-    all_questions = []
-    id_counter = 0  # Initialize a counter for question IDs
 
-    for _ in range(num_iterations):
-        questions_json = generate_questions(scenario, all_questions)
+    if args.resume:
+        run = load_run(collection, args.resume)
+        print(f"Resuming run {run['_id']}: {run['completed_iterations']} of {run['iterations']} question sets generated")
+    else:
+        scenario = input("Enter the scenario you want to explore: ")
+        num_iterations = int(input("How many sets of 10 questions do you want to generate? "))
+        if args.clear:
+            clear_collection(collection)
+        run = create_run(collection, scenario, num_iterations)
+
+    ensure_indexes(collection)
+    all_questions = list(collection.find({'run_id': run['_id']}, {'question_text': 1, 'id': 1}).sort('id', 1))
+    id_counter = max((q['id'] for q in all_questions), default=0)  # Continue numbering after the last stored question
+
+    for _ in range(run['iterations'] - run['completed_iterations']):
+        questions_json = generate_questions(run['scenario'], all_questions)
+        if questions_json is None:
+            print("Question set not generated; it stays pending for --resume")
+            continue
         # Update IDs to be cumulative and handle key inconsistencies
         questions_for_db = [{
+            'run_id': run['_id'],
             'question_text': q.get('question_text', 'No question text provided'),  # Extract 'question_text' and store as 'question_text'
             'id': id_counter + i + 1
         } for i, q in enumerate(questions_json)]
         
-        store_questions(collection, questions_for_db)
+        if not store_questions(collection, questions_for_db):
+            print("Question set not stored; it stays pending for --resume")
+            continue
+        mark_iteration_complete(collection, run)
         all_questions.extend(questions_for_db)  # Append directly the questions in the same format for context preparation
         id_counter += len(questions_json)  # Update the counter based on the number of questions generated
         
@@ -85,6 +150,7 @@ def main():
             print(f"- {question['question_text']}")  # Print using 'question_text' key
 
     print(f"Total questions generated: {len(all_questions)}")
+    print(f"Run id: {run['_id']}")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,19 @@
+from bson import ObjectId
+
+# The raw synthdata documents the vector store and the lexical index are built from: questions with
+# a non-empty answer, excluding documents of the older layout that carried their own embedding
+SOURCE_FILTER = {'embedding': {'$exists': False}, 'metadata.question_text': {'$exists': True}, 'metadata.answer': {'$nin': [None, '']}}
+WATCH_PIPELINE = [{'$match': {'operationType': {'$in': ['insert', 'update', 'replace', 'delete']}}}]
+
+def is_source(doc):
+    # Same test as SOURCE_FILTER, applied to a change event's full document
+    metadata = doc.get('metadata') or {}
+    return 'embedding' not in doc and 'question_text' in metadata and metadata.get('answer') not in (None, '')
+
+def source_text(metadata):
+    # The text embedded and indexed for a question
+    return f"Question: {metadata['question_text']} Answer: {metadata['answer']}"
+
+def source_id_value(source_id):
+    # Node metadata stores the source _id as a string; the raw documents use ObjectIds
+    return ObjectId(source_id) if ObjectId.is_valid(source_id) else source_id
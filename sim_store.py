@@ -0,0 +1,130 @@
+import time
+import random
+import threading
+from bson import json_util
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+SPILL_PATH = "unwritten_answers.jsonl"
+
+
+# Write-behind buffer for answer updates. add() only queues the operation; a background thread
+# sends unordered bulk_write batches when the buffer reaches batch_size, every flush_interval
+# seconds and on close(). Failed operations are retried with backoff and, once retries run out,
+# appended to a JSONL spill file, as are updates that matched no question, so no answer is ever
+# dropped without a trace.
+class AnswerWriter:
+    def __init__(self, collection, batch_size=100, flush_interval=2.0, max_retries=5, spill_path=SPILL_PATH):
+        self.collection = collection
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.spill_path = spill_path
+        self.pending = []
+        self.written = 0
+        self.spilled = 0
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.wake = threading.Event()
+        self.closed = False
+        self.thread = threading.Thread(target=self._run, name="answer-writer", daemon=True)
+        self.thread.start()
+
+    def add(self, filter, update):
+        with self.lock:
+            if self.closed:
+                raise RuntimeError("AnswerWriter is closed")
+            self.pending.append((filter, update))
+            full = len(self.pending) >= self.batch_size
+        if full:
+            self.wake.set()
+
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                operations, self.pending = self.pending, []
+            for start in range(0, len(operations), self.batch_size):
+                self._write(operations[start:start + self.batch_size])
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+        self.wake.set()
+        self.thread.join()
+        self.flush()
+        print(f"Answer writer: {self.written} answers written" + (f", {self.spilled} spilled to {self.spill_path}" if self.spilled else ""))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _run(self):
+        while not self.closed:
+            self.wake.wait(self.flush_interval)
+            self.wake.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Answer writer flush failed: {e}")
+
+    def _write(self, operations):
+        for attempt in range(self.max_retries + 1):
+            try:
+                result = self.collection.bulk_write([UpdateOne(filter, update) for filter, update in operations], ordered=False)
+                self._applied(operations, result.matched_count)
+                return
+            except BulkWriteError as e:
+                # Unordered batches apply every operation they can; only the failed ones are retried
+                failed = {error['index'] for error in e.details.get('writeErrors', [])}
+                self._applied([op for i, op in enumerate(operations) if i not in failed], e.details.get('nMatched', 0))
+                operations = [op for i, op in enumerate(operations) if i in failed]
+                if not operations:
+                    return
+                error = e
+            except Exception as e:
+                error = e
+            if attempt < self.max_retries:
+                delay = min(30.0, 0.5 * 2 ** attempt) * random.uniform(0.5, 1.0)
+                print(f"Answer write of {len(operations)} operations failed ({error}), retrying in {delay:.1f}s")
+                time.sleep(delay)
+        self._spill(operations, f"failed after {self.max_retries} retries ({error})")
+
+    def _applied(self, operations, matched):
+        # An update whose question document does not exist succeeds without writing anything. Retrying
+        # will not help, so when fewer operations matched than were sent, the unmatched ones are spilled
+        unmatched = []
+        if matched < len(operations):
+            unmatched = [(filter, update) for filter, update in operations if self.collection.find_one(filter, {'_id': 1}) is None]
+            if unmatched:
+                self._spill(unmatched, "matched no question document")
+        self.written += len(operations) - len(unmatched)
+
+    def _spill(self, operations, reason):
+        with open(self.spill_path, "a", encoding="utf-8") as f:
+            for filter, update in operations:
+                f.write(json_util.dumps({"filter": filter, "update": update}) + "\n")
+        self.spilled += len(operations)
+        print(f"ERROR: {len(operations)} answer writes {reason}; "
+              f"saved to {self.spill_path}, replay them with replay_spilled_answers()")
+
+def replay_spilled_answers(collection, spill_path=SPILL_PATH):
+    with open(spill_path, encoding="utf-8") as f:
+        entries = [json_util.loads(line) for line in f if line.strip()]
+    matched = 0
+    if entries:
+        matched = collection.bulk_write([UpdateOne(entry["filter"], entry["update"]) for entry in entries], ordered=False).matched_count
+    print(f"Replayed {len(entries)} spilled answer writes from {spill_path}"
+          + (f"; {len(entries) - matched} still matched no question document" if matched < len(entries) else ""))
+    return len(entries)
+
+def ensure_unique_index(collection, keys, partial_filter):
+    # Creates a unique partial index, first dropping one on the same keys that was created with other
+    # options, since MongoDB refuses to change the options of an existing index in place
+    name = "_".join(f"{field}_{direction}" for field, direction in keys)
+    existing = collection.index_information().get(name)
+    if existing and (not existing.get('unique') or existing.get('partialFilterExpression') != partial_filter):
+        print(f"Replacing index {name} on {collection.name}")
+        collection.drop_index(name)
+    collection.create_index(keys, unique=True, partialFilterExpression=partial_filter)
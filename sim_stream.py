@@ -0,0 +1,80 @@
+import json
+
+CLOSING_BRACKETS = {'}': '{', ']': '['}
+
+
+# Incremental parser for the streamed {"questions": [{"question_text": ...}, ...]} completion.
+# Every object that sits directly inside an array is handed back as soon as its closing brace arrives.
+class QuestionStreamParser:
+    def __init__(self):
+        self.text = ""
+        self.position = 0
+        self.stack = []
+        self.in_string = False
+        self.escape = False
+        self.object_start = None
+        self.object_depth = 0
+        self.emitted = 0
+        # Objects closed inside an array so far, questions or not, so close() knows where feed() stopped
+        self.seen = 0
+        self.malformed = False
+
+    def feed(self, chunk):
+        self.text += chunk
+        completed = []
+        while self.position < len(self.text) and not self.malformed:
+            char = self.text[self.position]
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif char == '\\':
+                    self.escape = True
+                elif char == '"':
+                    self.in_string = False
+            elif char == '"':
+                self.in_string = True
+            elif char in '{[':
+                if char == '{' and self.object_start is None and self.stack and self.stack[-1] == '[':
+                    self.object_start = self.position
+                    self.object_depth = len(self.stack)
+                self.stack.append(char)
+            elif char in '}]':
+                if not self.stack or self.stack[-1] != CLOSING_BRACKETS[char]:
+                    self.malformed = True
+                    break
+                self.stack.pop()
+                if char == '}' and self.object_start is not None and len(self.stack) == self.object_depth:
+                    question = self._parse_question(self.text[self.object_start:self.position + 1])
+                    self.object_start = None
+                    self.seen += 1
+                    if question is not None:
+                        completed.append(question)
+            self.position += 1
+        self.emitted += len(completed)
+        return completed
+
+    def close(self):
+        # Falls back to parsing the whole completion when feed() stopped at malformed input or found no
+        # question; the array objects feed() already went through are skipped, so none is returned twice
+        if self.emitted and not self.malformed:
+            return []
+        try:
+            questions = json.loads(self.text).get('questions', [])
+        except (ValueError, AttributeError) as e:
+            if self.emitted == 0:
+                print(f"Failed to parse streamed questions: {e}")
+            return []
+        remaining = [q for q in questions[self.seen:] if self._is_question(q)] if isinstance(questions, list) else []
+        self.emitted += len(remaining)
+        return remaining
+
+    def _parse_question(self, fragment):
+        try:
+            question = json.loads(fragment)
+        except ValueError:
+            self.malformed = True
+            return None
+        return question if self._is_question(question) else None
+
+    def _is_question(self, question):
+        return isinstance(question, dict) and ('question_text' in question or 'text' in question)
@@ -0,0 +1,510 @@
+import os
+import json
+import time
+import argparse
+import logging
+import operator
+from datetime import datetime, timezone
+import numpy as np
+from dotenv import load_dotenv
+from llama_index.core.bridge.pydantic import PrivateAttr
+from llama_index.core.vector_stores.types import (
+    BasePydanticVectorStore, VectorStoreQueryResult, VectorStoreQueryMode,
+    MetadataFilters, FilterOperator, FilterCondition
+)
+from llama_index.core.vector_stores.utils import metadata_dict_to_node, node_to_metadata_dict
+from sim_ann import ANN_INDEXES, IVFIndex, HNSWIndex, load_index, read_meta, top_k
+from sim_quant import QUANTIZATIONS, QuantizedCodes, decode_embedding, normalize
+
+VECTOR_BACKENDS = ["atlas", "local"]
+LOCAL_VECTOR_PATH = "vector_store"
+EMBEDDINGS_FILE = "embeddings.f32"
+NODES_FILE = "nodes.jsonl"
+DELETED_FILE = "deleted.npy"
+MANIFEST_FILE = "manifest.json"
+# One version counter per vector collection in the simulation database, bumped by every writer
+VECTOR_VERSIONS = "vector_versions"
+
+COMPARISONS = {
+    FilterOperator.EQ: operator.eq,
+    FilterOperator.NE: operator.ne,
+    FilterOperator.GT: operator.gt,
+    FilterOperator.GTE: operator.ge,
+    FilterOperator.LT: operator.lt,
+    FilterOperator.LTE: operator.le,
+    FilterOperator.IN: lambda value, values: value in values,
+    FilterOperator.NIN: lambda value, values: value not in values,
+    FilterOperator.CONTAINS: lambda value, item: isinstance(value, list) and item in value,
+}
+
+def matches(value, comparison, target):
+    try:
+        return value is not None and bool(comparison(value, target))
+    except TypeError:
+        return False
+
+
+# In-process vector store over a directory written by export_vectors(): unit-length float32
+# embeddings memory-mapped from disk as one contiguous matrix, plus each node's text and metadata.
+# Queries are a single matrix-vector product and an argpartition, so corpora that fit in RAM are
+# searched without a network round trip. Drop-in replacement for MongoDBAtlasVectorSearch.
+# When an IVF or HNSW index has been built for the directory, unfiltered queries only score the
+# candidates it returns. Rows keep their position for the life of the store; deletes are
+# tombstones until the next export, so saved indexes stay valid across add/delete/persist.
+# With `quantization` set, exact queries become two-stage: a coarse pass over compact in-memory
+# codes (optionally of only the first `coarse_dimensions`), then the best `rescore` x top_k
+# candidates are rescored against the full-precision rows, which are only paged in for them.
+class LocalVectorStore(BasePydanticVectorStore):
+    stores_text: bool = True
+    flat_metadata: bool = False
+    persist_dir: str = LOCAL_VECTOR_PATH
+    use_ann: bool = True
+    nprobe: int = 0
+    ef: int = 0
+    quantization: str = "none"
+    coarse_dimensions: int = 0
+    rescore: int = 4
+
+    _matrix = PrivateAttr()
+    _ids = PrivateAttr()
+    _texts = PrivateAttr()
+    _metadata = PrivateAttr()
+    _deleted = PrivateAttr()
+    _columns = PrivateAttr()
+    _version = PrivateAttr()
+    _ann = PrivateAttr()
+    _codes = PrivateAttr()
+    _rows = PrivateAttr()
+
+    def __init__(self, persist_dir=LOCAL_VECTOR_PATH, **kwargs):
+        super().__init__(persist_dir=persist_dir, **kwargs)
+        self._load()
+
+    @classmethod
+    def class_name(cls):
+        return "LocalVectorStore"
+
+    @property
+    def client(self):
+        return None
+
+    def __len__(self):
+        return len(self._ids) - int(self._deleted.sum())
+
+    def add(self, nodes, **add_kwargs):
+        # New rows live in memory until persist(); the memory-mapped rows are left as they are
+        if not nodes:
+            return []
+        rows = normalize([node.get_embedding() for node in nodes])
+        if len(self._ids) and rows.shape[1] != self._matrix.shape[1]:
+            raise ValueError(f"Embedding has {rows.shape[1]} dimensions, the store holds {self._matrix.shape[1]}")
+        if self._ann is not None:
+            self._ann.add(np.arange(len(self._ids), len(self._ids) + len(nodes)), rows)
+        self._matrix = np.vstack([self._matrix, rows]) if len(self._ids) else rows
+        if self._codes is not None:
+            self._codes.add(rows)
+        elif self.quantization != "none":
+            self.quantize(self.quantization, self.coarse_dimensions)
+        for node in nodes:
+            self._ids.append(node.node_id)
+            self._texts.append(node.get_content(metadata_mode="none") or "")
+            self._metadata.append(node_to_metadata_dict(node, remove_text=True, flat_metadata=False))
+        self._deleted = np.concatenate([self._deleted, np.zeros(len(nodes), dtype=bool)])
+        self._columns, self._rows = {}, None
+        return [node.node_id for node in nodes]
+
+    def delete(self, ref_doc_id, **delete_kwargs):
+        rows = np.flatnonzero((self._column("ref_doc_id") == ref_doc_id) & ~self._deleted)
+        self._deleted[rows] = True
+        if self._ann is not None:
+            self._ann.delete(rows)
+
+    def query(self, query, **kwargs):
+        if query.mode != VectorStoreQueryMode.DEFAULT or not query.query_embedding:
+            raise NotImplementedError(f"LocalVectorStore supports {VectorStoreQueryMode.DEFAULT} mode queries with an embedding only")
+        # Filtered queries stay exact: a selective filter can leave too few matches among the ANN candidates
+        use_ann = self._ann is not None and not (query.filters or query.doc_ids or query.node_ids)
+        best, scores = self._search(normalize(query.query_embedding), query.similarity_top_k, self._allowed(query), use_ann)
+        return VectorStoreQueryResult(
+            nodes=[self._node(i) for i in best],
+            similarities=[float(score) for score in scores],
+            ids=[self._ids[i] for i in best]
+        )
+
+    def embeddings(self, node_ids):
+        # Stored unit-length vectors of the given live nodes, {node_id: vector}
+        if self._rows is None:
+            self._rows = {node_id: row for row, node_id in enumerate(self._ids) if not self._deleted[row]}
+        rows = {node_id: self._rows[node_id] for node_id in node_ids if node_id in self._rows and not self._deleted[self._rows[node_id]]}
+        return {node_id: np.asarray(self._matrix[row]) for node_id, row in rows.items()}
+
+    def build_index(self, kind, nlist=None, nprobe=8, m=16, ef_construction=200, ef=64):
+        # Builds and saves an ANN index for the persisted rows; call after export or persist()
+        if kind not in ANN_INDEXES:
+            raise ValueError(f"Unknown index '{kind}', expected one of {ANN_INDEXES}")
+        if kind == "ivf":
+            self._ann = IVFIndex.build(self._matrix, nlist, nprobe)
+        else:
+            self._ann = HNSWIndex.build(self._matrix, m, ef_construction, ef, deleted=self._deleted)
+        self._ann.save(self.persist_dir, self._version)
+
+    def quantize(self, kind, dimensions=0):
+        # Builds the coarse codes for two-stage search, or drops them with kind "none"
+        if kind not in QUANTIZATIONS:
+            raise ValueError(f"Unknown quantization '{kind}', expected one of {QUANTIZATIONS}")
+        self.quantization, self.coarse_dimensions = kind, dimensions
+        self._codes = QuantizedCodes.build(kind, self._matrix, dimensions) if kind != "none" and len(self._matrix) else None
+
+    def persist(self, persist_path=None, fs=None):
+        path = persist_path or self.persist_dir
+        entries = [{'id': self._ids[i], 'text': self._texts[i], 'metadata': self._metadata[i]} for i in range(len(self._ids))]
+        self._version = write_store(path, [(self._matrix, entries)], self._deleted)
+        if self._ann is not None:
+            self._ann.save(path, self._version)
+
+    def _search(self, query, k, allowed, use_ann):
+        # Returns the best rows and their scores; `allowed` is a row mask or None for every live row
+        k = min(k, len(self))
+        if k <= 0:
+            return [], []
+        if use_ann:
+            rows = self._ann.search(query, k)
+            rows = rows[~self._deleted[rows]]
+            scores = np.asarray(self._matrix[rows]) @ query
+            order = top_k(scores, k)
+            return rows[order], scores[order]
+        if self._codes is not None:
+            return self._rescore(query, k, allowed)
+        scores = self._matrix @ query
+        if allowed is not None:
+            scores = np.where(allowed, scores, -np.inf)
+        best = [i for i in top_k(scores, k) if np.isfinite(scores[i])]
+        return best, scores[best]
+
+    def _rescore(self, query, k, allowed):
+        scores = self._codes.scores(query)
+        if allowed is not None:
+            scores = np.where(allowed, scores, -np.inf)
+        candidates = np.array([i for i in top_k(scores, k * max(1, self.rescore)) if np.isfinite(scores[i])], dtype=np.int64)
+        if not len(candidates):
+            return [], []
+        # Sorted so the memory-mapped rows are read in file order
+        candidates.sort()
+        exact = np.asarray(self._matrix[candidates]) @ query
+        order = top_k(exact, k)
+        return candidates[order], exact[order]
+
+    def _load(self):
+        manifest = read_manifest(self.persist_dir)
+        self._ann, self._codes, self._version = None, None, None
+        self._deleted = None
+        if manifest is None:
+            self._matrix, self._ids, self._texts, self._metadata = np.empty((0, 0), dtype=np.float32), [], [], []
+        else:
+            files = manifest["files"]
+            self._matrix = np.memmap(os.path.join(self.persist_dir, files["embeddings"]), dtype=np.float32, mode="r",
+                                     shape=(manifest["count"], manifest["dimensions"])) if manifest["count"] else np.empty((0, manifest["dimensions"]), dtype=np.float32)
+            self._ids, self._texts, self._metadata = [], [], []
+            with open(os.path.join(self.persist_dir, files["nodes"]), encoding="utf-8") as f:
+                for line in f:
+                    entry = json.loads(line)
+                    self._ids.append(entry["id"])
+                    self._texts.append(entry["text"])
+                    self._metadata.append(entry["metadata"])
+            self._version = manifest["written_at"]
+            deleted_path = os.path.join(self.persist_dir, files["deleted"])
+            if os.path.exists(deleted_path):
+                self._deleted = np.load(deleted_path)
+        if self._deleted is None:
+            self._deleted = np.zeros(len(self._ids), dtype=bool)
+        self._columns, self._rows = {}, None
+        if self.use_ann and self._version is not None:
+            self._ann = load_index(self.persist_dir, self._version)
+            if self._ann is not None:
+                self._ann.tune(nprobe=self.nprobe, ef=self.ef)
+        self.quantize(self.quantization, self.coarse_dimensions)
+
+    def _column(self, key):
+        # Metadata values by row, built once per key so repeated filters are vectorized comparisons
+        if key not in self._columns:
+            column = np.empty(len(self._metadata), dtype=object)
+            for i, metadata in enumerate(self._metadata):
+                column[i] = metadata.get(key)
+            self._columns[key] = column
+        return self._columns[key]
+
+    def _isin(self, values, allowed):
+        allowed = set(allowed)
+        return np.fromiter((value in allowed for value in values), dtype=bool, count=len(values))
+
+    def _allowed(self, query):
+        masks = [~self._deleted] if self._deleted.any() else []
+        if query.filters is not None:
+            masks.append(self._filter_mask(query.filters))
+        if query.doc_ids:
+            masks.append(self._isin(self._column("ref_doc_id"), query.doc_ids))
+        if query.node_ids:
+            masks.append(self._isin(self._ids, query.node_ids))
+        return np.logical_and.reduce(masks) if masks else None
+
+    def _filter_mask(self, filters):
+        masks = []
+        for metadata_filter in filters.filters:
+            if isinstance(metadata_filter, MetadataFilters):
+                masks.append(self._filter_mask(metadata_filter))
+                continue
+            if metadata_filter.operator not in COMPARISONS:
+                raise NotImplementedError(f"LocalVectorStore does not support the {metadata_filter.operator} filter operator")
+            column = self._column(metadata_filter.key)
+            if metadata_filter.operator == FilterOperator.EQ:
+                masks.append(column == metadata_filter.value)
+            else:
+                comparison = COMPARISONS[metadata_filter.operator]
+                masks.append(np.fromiter((matches(value, comparison, metadata_filter.value) for value in column), dtype=bool, count=len(column)))
+        if not masks:
+            return np.ones(len(self._ids), dtype=bool)
+        return np.logical_or.reduce(masks) if filters.condition == FilterCondition.OR else np.logical_and.reduce(masks)
+
+    def _node(self, i):
+        node = metadata_dict_to_node(self._metadata[i])
+        node.set_content(self._texts[i])
+        return node
+
+def read_manifest(path):
+    manifest_path = os.path.join(path, MANIFEST_FILE)
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path, encoding="utf-8") as f:
+        manifest = json.load(f)
+    # Stores written before the data files were named per version use the fixed names
+    manifest.setdefault("files", {"embeddings": EMBEDDINGS_FILE, "nodes": NODES_FILE, "deleted": DELETED_FILE})
+    return manifest
+
+def versioned_name(name, tag):
+    stem, extension = os.path.splitext(name)
+    return f"{stem}-{tag}{extension}"
+
+def write_store(path, blocks, deleted=None):
+    # Writes (embedding rows, node entries) blocks as they arrive, plus the tombstone mask, to data
+    # files named after the new version. Only the manifest, which names those files, is swapped in,
+    # so a reader loads either the old store or the new one, never a mix. Data files of older
+    # versions are then removed, except the previous version's, whose manifest a reader may have
+    # just read. Returns the new store version.
+    os.makedirs(path, exist_ok=True)
+    version = time.time()
+    tag = f"{version:.6f}".replace(".", "")
+    files = {"embeddings": versioned_name(EMBEDDINGS_FILE, tag), "nodes": versioned_name(NODES_FILE, tag),
+             "deleted": versioned_name(DELETED_FILE, tag)}
+    count, dimensions = 0, 0
+    with open(os.path.join(path, files["embeddings"]), "wb") as embeddings_file, \
+            open(os.path.join(path, files["nodes"]), "w", encoding="utf-8") as nodes_file:
+        for rows, entries in blocks:
+            if not len(entries):
+                continue
+            rows = np.ascontiguousarray(rows, dtype=np.float32)
+            dimensions = rows.shape[1]
+            count += len(rows)
+            embeddings_file.write(rows.tobytes())
+            for entry in entries:
+                nodes_file.write(json.dumps(entry, default=str) + "\n")
+    np.save(os.path.join(path, files["deleted"]), deleted if deleted is not None else np.zeros(count, dtype=bool))
+    previous = read_manifest(path)
+    manifest_tmp = os.path.join(path, MANIFEST_FILE + ".tmp")
+    with open(manifest_tmp, "w", encoding="utf-8") as f:
+        json.dump({"count": count, "dimensions": dimensions, "written_at": version, "files": files}, f)
+    os.replace(manifest_tmp, os.path.join(path, MANIFEST_FILE))
+    remove_stale_files(path, set(files.values()) | set(previous["files"].values() if previous else ()))
+    return version
+
+def remove_stale_files(path, keep):
+    prefixes = tuple(os.path.splitext(name)[0] for name in (EMBEDDINGS_FILE, NODES_FILE, DELETED_FILE))
+    for name in os.listdir(path):
+        if name.startswith(prefixes) and name not in keep and name != MANIFEST_FILE:
+            try:
+                os.remove(os.path.join(path, name))
+            except OSError as e:
+                # A file still memory-mapped cannot be removed on some platforms; the next write retries
+                logging.warning(f"Could not remove {name} from {path}: {e}")
+
+def export_vectors(vectors, path=LOCAL_VECTOR_PATH, chunk_size=1000):
+    # Streams the vector nodes out of MongoDB into a local store, normalizing one chunk at a time.
+    # The export is compact: rows deleted since the last export are gone and any ANN index is stale
+    # until it is rebuilt, which `python sim_vectors.py` does with the index's saved settings.
+    # Nodes written with the int8 or binary encodings of older versions carry their full-precision vector in embedding_full.
+    exported = [0]
+
+    def blocks():
+        rows, entries = [], []
+        for doc in vectors.find({}, {'embedding': 1, 'embedding_full': 1, 'text': 1, 'metadata': 1}, batch_size=chunk_size):
+            rows.append(decode_embedding(doc.get('embedding_full', doc['embedding'])))
+            entries.append({'id': str(doc['_id']), 'text': doc.get('text', ''), 'metadata': doc.get('metadata', {})})
+            if len(rows) >= chunk_size:
+                exported[0] += len(rows)
+                yield normalize(rows), entries
+                rows, entries = [], []
+        if rows:
+            exported[0] += len(rows)
+            yield normalize(rows), entries
+
+    write_store(path, blocks())
+    return exported[0]
+
+def benchmark(store, queries=200, k=10, noise=0.05):
+    # Recall@k of the ANN index against exact search, and the latency of both, over perturbed copies
+    # of stored vectors
+    rng = np.random.default_rng(0)
+    live = np.flatnonzero(~store._deleted)
+    sample = rng.choice(live, min(queries, len(live)), replace=False)
+    exact_times, ann_times, recalls = [], [], []
+    for row in sample:
+        query = normalize(np.asarray(store._matrix[row]) + rng.normal(scale=noise, size=store._matrix.shape[1]))
+        started = time.perf_counter()
+        exact, _ = store._search(query, k, None, False)
+        exact_times.append(time.perf_counter() - started)
+        started = time.perf_counter()
+        approximate, _ = store._search(query, k, None, True)
+        ann_times.append(time.perf_counter() - started)
+        recalls.append(len(set(exact) & set(approximate)) / max(1, len(exact)))
+    return {
+        'recall': float(np.mean(recalls)),
+        'exact_ms_p50': float(np.percentile(exact_times, 50) * 1000),
+        'ann_ms_p50': float(np.percentile(ann_times, 50) * 1000),
+        'ann_ms_p95': float(np.percentile(ann_times, 95) * 1000)
+    }
+
+def recall_report(store, settings, queries=200, k=10, noise=0.05):
+    # Recall@k against exact full-precision search for each (quantization, coarse dimensions) setting,
+    # with and without the rescoring stage, plus query latency and coarse code size per vector
+    rng = np.random.default_rng(0)
+    live = np.flatnonzero(~store._deleted)
+    sample = rng.choice(live, min(queries, len(live)), replace=False)
+    allowed = ~store._deleted if store._deleted.any() else None
+    query_vectors = [normalize(np.asarray(store._matrix[row]) + rng.normal(scale=noise, size=store._matrix.shape[1])) for row in sample]
+    previous = (store.quantization, store.coarse_dimensions)
+    store.quantize("none")
+    exact = [set(store._search(query, k, allowed, False)[0]) for query in query_vectors]
+    results = []
+    for kind, dimensions in settings:
+        store.quantize(kind, dimensions)
+        coarse_recalls, recalls, times = [], [], []
+        for query, truth in zip(query_vectors, exact):
+            scores = store._codes.scores(query)
+            if allowed is not None:
+                scores = np.where(allowed, scores, -np.inf)
+            coarse_recalls.append(len(truth & set(top_k(scores, k))) / max(1, len(truth)))
+            started = time.perf_counter()
+            best, _ = store._search(query, k, allowed, False)
+            times.append(time.perf_counter() - started)
+            recalls.append(len(truth & set(best)) / max(1, len(truth)))
+        results.append({
+            'quantization': kind,
+            'dimensions': store._codes.dimensions,
+            'bytes_per_vector': store._codes.bytes_per_vector(),
+            'coarse_recall': float(np.mean(coarse_recalls)),
+            'rescored_recall': float(np.mean(recalls)),
+            'ms_p50': float(np.percentile(times, 50) * 1000),
+            'ms_p95': float(np.percentile(times, 95) * 1000)
+        })
+    store.quantize(*previous)
+    return results
+
+def mark_vectors_changed(collection):
+    # Lets readers such as the sim_chat.py query cache tell that a vector collection changed
+    collection.database[VECTOR_VERSIONS].update_one(
+        {'_id': collection.name}, {'$inc': {'version': 1}, '$set': {'updated_at': datetime.now(timezone.utc)}}, upsert=True)
+
+def vector_version(vector_store, mongo_client, collection_name="synthdata_vectors"):
+    # A local store only changes when it is exported again; Atlas collections carry a version counter
+    if isinstance(vector_store, LocalVectorStore):
+        return vector_store._version
+    doc = mongo_client["simulation"][VECTOR_VERSIONS].find_one({'_id': collection_name})
+    return doc.get('version') if doc else None
+
+def node_embeddings(vector_store, node_ids):
+    # Stored embeddings of retrieved nodes, which query results do not carry; nodes missing from the
+    # store are left out. Atlas nodes are read in one query that projects only the vectors.
+    if isinstance(vector_store, LocalVectorStore):
+        return vector_store.embeddings(node_ids)
+    cursor = vector_store._collection.find({'_id': {'$in': list(node_ids)}}, {'embedding': 1, 'embedding_full': 1})
+    return {doc['_id']: decode_embedding(doc.get('embedding_full', doc['embedding'])) for doc in cursor}
+
+def build_vector_store(mongo_client, collection_name="synthdata_vectors"):
+    # SIM_VECTOR_BACKEND=atlas (default) queries MongoDB Atlas Vector Search; local serves queries from
+    # the store that `python sim_vectors.py` exports to SIM_LOCAL_VECTOR_PATH
+    backend = os.getenv("SIM_VECTOR_BACKEND", "atlas")
+    if backend not in VECTOR_BACKENDS:
+        raise ValueError(f"Unknown vector backend '{backend}', expected one of {VECTOR_BACKENDS}")
+    if backend == "local":
+        # SIM_ANN_NPROBE and SIM_ANN_EF override the saved query settings of an IVF or HNSW index;
+        # SIM_VECTOR_QUANTIZATION, SIM_VECTOR_COARSE_DIMENSIONS and SIM_VECTOR_RESCORE turn on two-stage search
+        store = LocalVectorStore(os.getenv("SIM_LOCAL_VECTOR_PATH", LOCAL_VECTOR_PATH),
+                                 nprobe=int(os.getenv("SIM_ANN_NPROBE", "0")), ef=int(os.getenv("SIM_ANN_EF", "0")),
+                                 quantization=os.getenv("SIM_VECTOR_QUANTIZATION", "none"),
+                                 coarse_dimensions=int(os.getenv("SIM_VECTOR_COARSE_DIMENSIONS", "0")),
+                                 rescore=int(os.getenv("SIM_VECTOR_RESCORE", "4")))
+        if not len(store):
+            raise ValueError("The local vector store is empty. Run `python sim_vectors.py` after sim_embed.py to export it.")
+        return store
+    from llama_index.vector_stores.mongodb import MongoDBAtlasVectorSearch
+    return MongoDBAtlasVectorSearch(mongo_client, db_name="simulation", collection_name=collection_name, index_name="vector_index", embedding_key="embedding")
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Export the MongoDB vector nodes into a local memory-mapped vector store")
+    parser.add_argument("--path", default=os.getenv("SIM_LOCAL_VECTOR_PATH", LOCAL_VECTOR_PATH), help="Directory to write the local store to")
+    parser.add_argument("--vector-collection", default="synthdata_vectors", help="Collection in the simulation database to export")
+    parser.add_argument("--chunk-size", type=int, default=1000, help="Vector nodes read and written per step")
+    parser.add_argument("--skip-export", action="store_true", help="Use the store already in --path instead of exporting again")
+    parser.add_argument("--index", choices=ANN_INDEXES, help="Build an approximate nearest-neighbour index over the store")
+    parser.add_argument("--nlist", type=int, help="IVF buckets (default 4 x sqrt(rows))")
+    parser.add_argument("--nprobe", type=int, default=8, help="IVF buckets scanned per query")
+    parser.add_argument("--m", type=int, default=16, help="HNSW links per node")
+    parser.add_argument("--ef-construction", type=int, default=200, help="HNSW beam width while building")
+    parser.add_argument("--ef", type=int, default=64, help="HNSW beam width per query")
+    parser.add_argument("--benchmark", type=int, default=0, help="Measure recall and latency of the index over this many queries")
+    parser.add_argument("--k", type=int, default=10, help="Results per benchmark query")
+    parser.add_argument("--recall-report", type=int, default=0, help="Measure recall of every quantization setting over this many queries")
+    parser.add_argument("--coarse-dimensions", type=int, nargs="+", default=[0, 512, 256], help="Coarse dimensions compared by --recall-report (0 = all)")
+    parser.add_argument("--rescore", type=int, default=4, help="Candidates rescored at full precision per result")
+    return parser.parse_args()
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    load_dotenv(os.path.join(os.path.dirname(__file__), '.env'))
+    args = parse_args()
+    # An export replaces every row, so an index built over the previous export is rebuilt with its saved settings
+    previous_index = None if args.skip_export or args.index else read_meta(args.path)
+    if not args.skip_export:
+        import pymongo
+        mongo_client = pymongo.MongoClient(os.getenv("MONGO_URI"))
+        started = time.perf_counter()
+        count = export_vectors(mongo_client["simulation"][args.vector_collection], args.path, args.chunk_size)
+        logging.info(f"Exported {count} vector nodes to {args.path} in {time.perf_counter() - started:.1f}s.")
+
+    store = LocalVectorStore(args.path, use_ann=not (args.index or previous_index), nprobe=args.nprobe, ef=args.ef)
+    if args.index:
+        started = time.perf_counter()
+        store.build_index(args.index, nlist=args.nlist, nprobe=args.nprobe, m=args.m, ef_construction=args.ef_construction, ef=args.ef)
+        logging.info(f"Built {args.index} index over {len(store)} vectors in {time.perf_counter() - started:.1f}s.")
+    elif previous_index:
+        started = time.perf_counter()
+        store.build_index(previous_index["kind"], nlist=args.nlist, nprobe=previous_index.get("nprobe", args.nprobe),
+                          m=previous_index.get("m", args.m), ef_construction=previous_index.get("ef_construction", args.ef_construction),
+                          ef=previous_index.get("ef", args.ef))
+        logging.info(f"Rebuilt the {previous_index['kind']} index over {len(store)} exported vectors in {time.perf_counter() - started:.1f}s.")
+    if args.benchmark:
+        if store._ann is None:
+            raise SystemExit("No index to benchmark; pass --index ivf or --index hnsw.")
+        results = benchmark(store, args.benchmark, args.k)
+        logging.info(f"recall@{args.k} {results['recall']:.3f}, exact p50 {results['exact_ms_p50']:.2f}ms, "
+                     f"{store._ann.kind} p50 {results['ann_ms_p50']:.2f}ms, p95 {results['ann_ms_p95']:.2f}ms")
+    if args.recall_report:
+        store.rescore = args.rescore
+        settings = [(kind, dimensions) for kind in QUANTIZATIONS[1:] for dimensions in args.coarse_dimensions
+                    if not (kind == "float32" and dimensions in (0, store._matrix.shape[1]))]
+        for result in recall_report(store, settings, args.recall_report, args.k):
+            logging.info(f"{result['quantization']:>7} x {result['dimensions']:>4} dims, {result['bytes_per_vector']:>5} bytes/vector: "
+                         f"recall@{args.k} {result['coarse_recall']:.3f} coarse, {result['rescored_recall']:.3f} rescored "
+                         f"({args.rescore}x candidates), p50 {result['ms_p50']:.2f}ms, p95 {result['ms_p95']:.2f}ms")
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,24 @@
 import os
 import json
+import time
+import asyncio
+import argparse
+import uuid
+from datetime import datetime, timezone
 from dotenv import load_dotenv
-from pymongo import MongoClient
-from openai import OpenAI
+from pymongo import MongoClient, UpdateOne
+from sim_stream import QuestionStreamParser
+from sim_context import CONTEXT_STRATEGIES, PriorContext
+from sim_dedup import QuestionDeduper
+from sim_store import AnswerWriter, ensure_unique_index
+from sim_cache import CACHE_MODES, LLMCache
+from sim_llm import LLMClient
 
 # Load environment variables
 load_dotenv()
 
-# Setup OpenAI client
-openai_client = OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
+# Setup OpenAI client: rate limited, retried and optionally cached (see sim_llm.py)
+llm = LLMClient.from_env()
 
 # MongoDB setup
 def connect_to_mongodb():
@@ -19,94 +29,523 @@ def connect_to_mongodb():
 
 def clear_collection(collection):
     collection.delete_many({})
+    runs_collection(collection).delete_many({})
     print("Collection cleared successfully.")
 
+def runs_collection(collection):
+    return collection.database["runs"]
+
+def ensure_indexes(collection):
+    # One question per (run, number). The filter only covers documents that have a number, so questions
+    # written by sim_questions.py (keyed on a top-level id) and nodes written by the embed step are left out
+    ensure_unique_index(collection, [("run_id", 1), ("metadata.number", 1)],
+                        {"run_id": {"$exists": True}, "metadata.number": {"$exists": True}})
+
+def new_run_id():
+    return datetime.now().strftime("%Y%m%d-%H%M%S-") + uuid.uuid4().hex[:6]
+
+def create_run(collection, scenario, num_iterations, batch_id=None):
+    run = {
+        '_id': new_run_id(),
+        'scenario': scenario,
+        'iterations': num_iterations,
+        'completed_iterations': 0,
+        'created_at': datetime.now(timezone.utc),
+        'producer': 'sims_start'
+    }
+    if batch_id:
+        run['batch_id'] = batch_id
+    runs_collection(collection).insert_one(run)
+    print(f"Started run {run['_id']}")
+    return run
+
+def load_run(collection, run_id):
+    run = runs_collection(collection).find_one({'_id': run_id})
+    if not run:
+        raise ValueError(f"No run found with id {run_id}")
+    return run
+
+def mark_iteration_complete(collection, run):
+    run['completed_iterations'] += 1
+    runs_collection(collection).update_one({'_id': run['_id']}, {'$inc': {'completed_iterations': 1}})
+
+def load_run_questions(collection, run_id):
+    return list(collection.find({"run_id": run_id}).sort("metadata.number", 1))
+
+def question_filter(question):
+    return {"run_id": question.get('run_id'), "metadata.number": question['metadata']['number']}
+
 def store_questions(collection, questions):
+    # Upserts keyed on (run_id, number) make a retried batch a no-op instead of a duplicate. Returns
+    # False when the write failed; the set is then not counted as complete and --resume generates it again
     if questions:
         try:
-            collection.insert_many(questions)
+            collection.bulk_write([
+                UpdateOne(question_filter(q), {"$setOnInsert": {f"metadata.{k}": v for k, v in q['metadata'].items() if k != 'number'}}, upsert=True)
+                for q in questions
+            ], ordered=False)
             print("Questions stored successfully.")
         except Exception as e:
-            print(f"Error storing questions: {e}")
+            print(f"ERROR: storing questions failed: {e}")
+            return False
     else:
         print("No questions to store.")
+    return True
 
 def fetch_question_by_id(collection, question_number):
     return collection.find_one({"metadata.number": question_number})
 
-def store_answer(collection, question_number, answer):
-    collection.update_one({"metadata.number": question_number}, {"$set": {"metadata.answer": answer}})
+def store_answer(answer_writer, question, answer):
+    # Queued on the write-behind buffer, which sends answers to MongoDB in bulk batches.
+    # A failed call is never stored as an empty answer, so --resume picks the question up again
+    if not answer:
+        print(f"No answer for question number {question['metadata']['number']}, leaving it unanswered")
+        return False
+    answer_writer.add(question_filter(question), {"$set": {"metadata.answer": answer}})
+    print(f"Queued detailed response for question number {question['metadata']['number']}")
+    return True
 
-def generate_questions(scenario, previous_questions):
-    prior_context = " ".join([q['metadata']['question_text'] for q in previous_questions]) if previous_questions else ""
+def build_question_messages(scenario, previous_questions, context=None):
+    question_texts = [q['metadata']['question_text'] for q in previous_questions]
+    prior_context = context.build(question_texts) if context else " ".join(question_texts)
     user_prompt = (f"Considering these previous questions: {prior_context} Now, generate a list of 10 new questions about the consequences of {scenario}, "
                    "focusing on both immediate and long-term impacts in JSON format. Mention the scenario in the question. "
                    "Each question should be a JSON object with the key 'question_text'.") if prior_context else (
                    f"Generate a list of 10 new questions about the consequences of {scenario} in JSON format, covering both immediate and long-term impacts. "
                    "Mention the scenario in the question. Each question should be a JSON object with the key 'question_text'.")
 
-    messages = [
+    return [
         {"role": "system", "content": "You are a helpful AI tasked with generating insightful questions in JSON format. Each question should be formatted as a JSON object with a single key 'question_text' that holds the question text."},
         {"role": "user", "content": user_prompt}
     ]
 
+def record_question_prompt(context, messages, prompt_tokens):
+    if context:
+        context.record_prompt(messages, prompt_tokens)
+
+def generate_questions(scenario, previous_questions, context=None):
+    # Returns None when generation failed, so the caller leaves the set pending instead of counting it done
+    messages = build_question_messages(scenario, previous_questions, context)
+    try:
+        content, prompt_tokens = llm.chat(
+            model="gpt-4o",
+            messages=messages,
+            response_format={"type": "json_object"}
+        )
+        record_question_prompt(context, messages, prompt_tokens)
+        generated_questions = json.loads(content).get('questions', [])
+        print("Generated questions JSON:", generated_questions)
+    except Exception as e:
+        print(f"Failed to generate questions: {e}")
+        return None
+    return context.filter_novel(generated_questions) if context else generated_questions
+
+async def generate_questions_async(scenario, previous_questions, context=None):
+    messages = await asyncio.to_thread(build_question_messages, scenario, previous_questions, context)
     try:
-        response = openai_client.chat.completions.create(
+        content, prompt_tokens = await llm.achat(
             model="gpt-4o",
             messages=messages,
             response_format={"type": "json_object"}
         )
-        generated_questions = json.loads(response.choices[0].message.content).get('questions', [])
+        record_question_prompt(context, messages, prompt_tokens)
+        generated_questions = json.loads(content).get('questions', [])
         print("Generated questions JSON:", generated_questions)
-        return generated_questions
     except Exception as e:
         print(f"Failed to generate questions: {e}")
-        return []
+        return None
+    return await asyncio.to_thread(context.filter_novel, generated_questions) if context else generated_questions
+
+async def stream_questions_async(scenario, previous_questions, context=None):
+    # Yields each question as soon as its JSON object is complete in the streamed completion. A failed
+    # stream still yields what was parsed before the failure, then raises it
+    messages = await asyncio.to_thread(build_question_messages, scenario, previous_questions, context)
+    if context:
+        # Streamed completions carry no usage block, so the prompt size is estimated locally
+        context.record_prompt(messages)
+    parser = QuestionStreamParser()
+    error = None
+    try:
+        async for text in llm.astream("gpt-4o", messages, response_format={"type": "json_object"}):
+            for question in parser.feed(text):
+                if not context or await asyncio.to_thread(context.filter_novel, [question]):
+                    print("Streamed question JSON:", question)
+                    yield question
+    except Exception as e:
+        error = e
+    for question in parser.close():
+        if not context or await asyncio.to_thread(context.filter_novel, [question]):
+            print("Streamed question JSON:", question)
+            yield question
+    if error is not None:
+        raise error
+
+def build_questions_for_db(questions_json, number_counter, deduper=None, run_id=None):
+    # Near-duplicates of earlier questions are left out before any answer is paid for;
+    # they come back as (kept question number, duplicate text) pairs. The kept questions' signatures
+    # are returned too and only go into the deduper once the questions are stored (see index_questions)
+    questions_for_db = []
+    duplicates = []
+    signatures = {}
+    for q in questions_json:
+        question_text = q.get('question_text', q.get('text', 'No question text provided'))
+        number = number_counter + len(questions_for_db) + 1
+        if deduper:
+            duplicate_of, signature = deduper.check(question_text, signatures)
+            if duplicate_of is not None:
+                print(f"Skipping near-duplicate of question number {duplicate_of}: {question_text}")
+                duplicates.append((duplicate_of, question_text))
+                continue
+            signatures[number] = signature
+        questions_for_db.append({'run_id': run_id, 'metadata': {'question_text': question_text, 'number': number}})
+    return questions_for_db, duplicates, signatures
+
+def index_questions(deduper, questions_for_db, signatures):
+    if deduper:
+        for question in questions_for_db:
+            number = question['metadata']['number']
+            deduper.add(question['metadata']['question_text'], number, signatures[number])
+
+def store_paraphrases(collection, run_id, duplicates):
+    for question_number, question_text in duplicates:
+        collection.update_one({"run_id": run_id, "metadata.number": question_number}, {"$addToSet": {"metadata.paraphrases": question_text}})
+
+def build_answer_messages(question_text):
+    return [
+        {"role": "system", "content": "You are a knowledgeable AI tasked with imagening and simulating the most likely future outcomes for the scenario described in the question. Answer the question with a detailed response."},
+        {"role": "user", "content": "Provide a detailed answer to the following question simulating this  scenario in the future " + question_text}
+    ]
 
 def generate_detailed_response(question_text):
+    # Returns "" once retries are exhausted; callers leave such questions unanswered
     try:
-        response = openai_client.chat.completions.create(
+        content, _ = llm.chat(
             model="gpt-3.5-turbo",
-            messages=[
-                {"role": "system", "content": "You are a knowledgeable AI tasked with imagening and simulating the most likely future outcomes for the scenario described in the question. Answer the question with a detailed response."},
-                {"role": "user", "content": "Provide a detailed answer to the following question simulating this  scenario in the future " + question_text}
-            ],
+            messages=build_answer_messages(question_text),
             max_tokens=4096
         )
-        detailed_response = response.choices[0].message.content.strip()
+        detailed_response = content.strip()
         print(f"Generated Response: {detailed_response}")
         return detailed_response
     except Exception as e:
         print(f"Failed to generate response: {e}")
         return ""
 
-def main():
-    print("Welcome to the Simulation Question and Response Generator!")
-    scenario = input("Enter the scenario you want to explore: ")
-    num_iterations = int(input("How many sets of 10 questions do you want to generate? "))
+async def generate_detailed_response_async(question_text):
+    try:
+        content, _ = await llm.achat(
+            model="gpt-3.5-turbo",
+            messages=build_answer_messages(question_text),
+            max_tokens=4096
+        )
+        detailed_response = content.strip()
+        print(f"Generated Response: {detailed_response}")
+        return detailed_response
+    except Exception as e:
+        print(f"Failed to generate response: {e}")
+        return ""
 
-    collection = connect_to_mongodb()
-    clear_collection(collection)
+def answer_questions(answer_writer, questions_for_db):
+    for question in questions_for_db:
+        question_text = question['metadata']['question_text']
+        detailed_response = generate_detailed_response(question_text)
+        store_answer(answer_writer, question, detailed_response)
+
+async def answer_questions_async(answer_writer, questions_for_db, concurrency):
+    # At most `concurrency` answer requests are in flight; results come back in question order
+    semaphore = asyncio.Semaphore(concurrency)
 
-    all_questions = []
-    number_counter = 0
+    async def answer(question):
+        async with semaphore:
+            detailed_response = await generate_detailed_response_async(question['metadata']['question_text'])
+        store_answer(answer_writer, question, detailed_response)
+        return detailed_response
+
+    results = await asyncio.gather(*(answer(q) for q in questions_for_db), return_exceptions=True)
+    for question, result in zip(questions_for_db, results):
+        if isinstance(result, Exception):
+            print(f"Failed to answer question number {question['metadata']['number']}: {result}")
+    return results
+
+def last_question_number(all_questions):
+    return max((q['metadata']['number'] for q in all_questions), default=0)
+
+async def run_batches(collection, answer_writer, run, all_questions, concurrency, context=None, deduper=None, merge_duplicates=False):
+    number_counter = last_question_number(all_questions)
+
+    for _ in range(run['iterations'] - run['completed_iterations']):
+        questions_json = await asyncio.to_thread(generate_questions, run['scenario'], all_questions, context)
+        if questions_json is None:
+            print("Question set not generated; it stays pending for --resume")
+            continue
+        questions_for_db, duplicates, signatures = build_questions_for_db(questions_json, number_counter, deduper, run['_id'])
+        # A failed unordered write may still have stored some of the set, so its numbers are never reused
+        number_counter += len(questions_for_db)
 
-    for _ in range(num_iterations):
-        questions_json = generate_questions(scenario, all_questions)
-        questions_for_db = [{'metadata': {'question_text': q.get('question_text', q.get('text', 'No question text provided')), 'number': number_counter + i + 1}} for i, q in enumerate(questions_json)]
-        
-        store_questions(collection, questions_for_db)
+        if not await asyncio.to_thread(store_questions, collection, questions_for_db):
+            print("Question set not stored; it stays pending for --resume")
+            continue
+        index_questions(deduper, questions_for_db, signatures)
+        if merge_duplicates:
+            await asyncio.to_thread(store_paraphrases, collection, run['_id'], duplicates)
+        await asyncio.to_thread(mark_iteration_complete, collection, run)
         all_questions.extend(questions_for_db)
-        number_counter += len(questions_json)
 
+        if concurrency > 1:
+            await answer_questions_async(answer_writer, questions_for_db, concurrency)
+        else:
+            await asyncio.to_thread(answer_questions, answer_writer, questions_for_db)
+
+    return all_questions
+
+class StageStats:
+    def __init__(self, name):
+        self.name = name
+        self.items = 0
+        self.calls = 0
+        self.failures = 0
+        self.busy_seconds = 0.0
+        self.first_item_seconds = []
+
+    def record_first_item(self, elapsed):
+        self.first_item_seconds.append(elapsed)
+
+    def record(self, items, elapsed, failed=False):
+        self.items += items
+        self.calls += 1
+        self.failures += int(failed)
+        self.busy_seconds += elapsed
+
+    def report(self, wall_seconds):
+        per_minute = self.items / wall_seconds * 60 if wall_seconds else 0.0
+        avg_call = self.busy_seconds / self.calls if self.calls else 0.0
+        print(f"{self.name}: {self.items} items from {self.calls} calls ({self.failures} failed), "
+              f"{per_minute:.1f} items/min, {avg_call:.2f}s avg per call")
+        if self.first_item_seconds:
+            avg_first = sum(self.first_item_seconds) / len(self.first_item_seconds)
+            print(f"{self.name}: {avg_first:.2f}s avg until the first item of a call")
+
+async def run_pipeline(collection, answer_writer, run, all_questions, concurrency, max_queued, stream=False, context=None,
+                       deduper=None, merge_duplicates=False):
+    # The question producer fills a bounded queue that answer workers drain; a full queue
+    # pauses question generation so a slow answer stage never builds up unbounded work
+    queue = asyncio.Queue(maxsize=max_queued)
+    question_stats = StageStats("Question generation")
+    answer_stats = StageStats("Answer generation")
+    scenario = run['scenario']
+
+    async def produce():
+        number_counter = last_question_number(all_questions)
+        try:
+            for _ in range(run['iterations'] - run['completed_iterations']):
+                if stream:
+                    number_counter = await produce_streamed(number_counter)
+                else:
+                    number_counter = await produce_batch(number_counter)
+        finally:
+            for _ in range(concurrency):
+                await queue.put(None)
+
+    async def produce_batch(number_counter):
+        started = time.perf_counter()
+        questions_json = await generate_questions_async(scenario, all_questions, context)
+        question_stats.record(len(questions_json or []), time.perf_counter() - started, failed=questions_json is None)
+        if questions_json is None:
+            print("Question set not generated; it stays pending for --resume")
+            return number_counter
+        questions_for_db, duplicates, signatures = build_questions_for_db(questions_json, number_counter, deduper, run['_id'])
+        # A failed unordered write may still have stored some of the set, so its numbers are never reused
+        if not await asyncio.to_thread(store_questions, collection, questions_for_db):
+            print("Question set not stored; it stays pending for --resume")
+            return number_counter + len(questions_for_db)
+        index_questions(deduper, questions_for_db, signatures)
+        if merge_duplicates:
+            await asyncio.to_thread(store_paraphrases, collection, run['_id'], duplicates)
+        await asyncio.to_thread(mark_iteration_complete, collection, run)
+        all_questions.extend(questions_for_db)
         for question in questions_for_db:
-            question_text = question['metadata']['question_text']
-            detailed_response = generate_detailed_response(question_text)
-            store_answer(collection, question['metadata']['number'], detailed_response)
-            print(f"Stored detailed response for question number {question['metadata']['number']}")
+            await queue.put(question)
+        return number_counter + len(questions_for_db)
+
+    async def produce_streamed(number_counter):
+        # Questions are stored and queued one at a time while the rest of the set is still streaming;
+        # the prompt context stays the questions known before this set was requested. The stream holds a
+        # request slot until it ends, so a separate task reads it into an unbounded buffer (one set, about
+        # 10 questions) and only this loop waits on the bounded answer queue
+        started = time.perf_counter()
+        previous_questions = list(all_questions)
+        buffered = asyncio.Queue()
+
+        async def read_stream():
+            try:
+                async for question_json in stream_questions_async(scenario, previous_questions, context):
+                    if not streamed:
+                        question_stats.record_first_item(time.perf_counter() - started)
+                    streamed.append(question_json)
+                    buffered.put_nowait(question_json)
+            finally:
+                buffered.put_nowait(None)
+
+        streamed = []
+        reader = asyncio.create_task(read_stream())
+        failed = False
+        while True:
+            question_json = await buffered.get()
+            if question_json is None:
+                break
+            if failed:
+                continue
+            questions_for_db, duplicates, signatures = build_questions_for_db([question_json], number_counter, deduper, run['_id'])
+            if merge_duplicates:
+                await asyncio.to_thread(store_paraphrases, collection, run['_id'], duplicates)
+            if not questions_for_db:
+                continue
+            # The number is used up even when the write fails, since the question may have been stored anyway
+            number_counter += 1
+            if not await asyncio.to_thread(store_questions, collection, questions_for_db):
+                failed = True
+                continue
+            index_questions(deduper, questions_for_db, signatures)
+            all_questions.extend(questions_for_db)
+            await queue.put(questions_for_db[0])
+        try:
+            await reader
+        except Exception as e:
+            print(f"Failed to generate questions: {e}")
+            failed = True
+        if failed:
+            # Questions stored before the failure are kept and answered; the set itself stays pending for --resume
+            print("Question set incomplete; it stays pending for --resume")
+        question_stats.record(len(streamed), time.perf_counter() - started, failed=failed)
+        if not failed:
+            await asyncio.to_thread(mark_iteration_complete, collection, run)
+        return number_counter
+
+    async def consume():
+        while True:
+            question = await queue.get()
+            if question is None:
+                break
+            number = question['metadata']['number']
+            try:
+                started = time.perf_counter()
+                detailed_response = await generate_detailed_response_async(question['metadata']['question_text'])
+                answer_stats.record(1, time.perf_counter() - started, failed=not detailed_response)
+                store_answer(answer_writer, question, detailed_response)
+            except Exception as e:
+                print(f"Failed to answer question number {number}: {e}")
+
+    started = time.perf_counter()
+    await asyncio.gather(produce(), *(consume() for _ in range(concurrency)))
+    wall_seconds = time.perf_counter() - started
+
+    print(f"Pipeline finished in {wall_seconds:.1f}s")
+    question_stats.report(wall_seconds)
+    answer_stats.report(wall_seconds)
+    return all_questions
+
+def configure_cache(mode):
+    if mode:
+        llm.cache = LLMCache.from_env(mode)
+
+async def run_simulation(collection, answer_writer, run, all_questions, args, context, deduper):
+    # The whole run shares one event loop, and with it one pool of async OpenAI connections
+    try:
+        unanswered = [q for q in all_questions if not q['metadata'].get('answer')]
+        if unanswered:
+            print(f"Answering {len(unanswered)} unanswered questions from the earlier attempt")
+            if args.concurrency > 1:
+                await answer_questions_async(answer_writer, unanswered, args.concurrency)
+            else:
+                await asyncio.to_thread(answer_questions, answer_writer, unanswered)
+
+        if args.pipeline or args.stream:
+            await run_pipeline(collection, answer_writer, run, all_questions, args.concurrency, args.max_queued,
+                               stream=args.stream, context=context, deduper=deduper,
+                               merge_duplicates=args.merge_duplicates)
+        else:
+            await run_batches(collection, answer_writer, run, all_questions, args.concurrency, context, deduper, args.merge_duplicates)
+    finally:
+        await llm.aclose()
+
+def simulate(collection, run, args):
+    # Answers whatever the run left unanswered, then generates its remaining question sets
+    configure_cache(args.cache)
+    all_questions = load_run_questions(collection, run['_id'])
+
+    context = PriorContext(args.context_strategy, args.context_tokens, args.novelty_threshold, llm)
+    context.seed([question['metadata']['question_text'] for question in all_questions])
+    deduper = QuestionDeduper(args.dedup_threshold) if args.dedup_threshold > 0 else None
+    if deduper:
+        for question in all_questions:
+            deduper.add(question['metadata']['question_text'], question['metadata']['number'])
+
+    with AnswerWriter(collection, batch_size=args.write_batch_size, flush_interval=args.write_interval) as answer_writer:
+        asyncio.run(run_simulation(collection, answer_writer, run, all_questions, args, context, deduper))
+
+    context.report()
+    if deduper:
+        deduper.report()
+    llm.report()
+    return all_questions
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Simulation Question and Response Generator")
+    parser.add_argument("--resume", metavar="RUN_ID",
+                        help="Continue an earlier run: answer its unanswered questions, then generate its remaining question sets")
+    parser.add_argument("--clear", action="store_true",
+                        help="Delete every stored question and run before starting a new run")
+    parser.add_argument("--scenario", help="Scenario to explore (prompted for if omitted)")
+    parser.add_argument("--iterations", type=int, help="Number of sets of 10 questions (prompted for if omitted)")
+    add_simulation_arguments(parser)
+    return parser.parse_args()
+
+def add_simulation_arguments(parser):
+    parser.add_argument("--concurrency", type=int, default=1,
+                        help="Maximum answer requests in flight; values above 1 use the async OpenAI client")
+    parser.add_argument("--pipeline", action="store_true",
+                        help="Generate the next question set while answer workers drain the current one")
+    parser.add_argument("--max-queued", type=int, default=20,
+                        help="Questions allowed to wait for an answer worker before question generation pauses")
+    parser.add_argument("--stream", action="store_true",
+                        help="Stream question generation and dispatch each question as soon as it is parsed (implies --pipeline)")
+    parser.add_argument("--context-strategy", choices=CONTEXT_STRATEGIES, default="full",
+                        help="How previous questions are fitted into the question prompt")
+    parser.add_argument("--context-tokens", type=int, default=1500,
+                        help="Token budget for previous questions with the recent and representative strategies")
+    parser.add_argument("--novelty-threshold", type=float, default=0.0,
+                        help="Drop generated questions whose embedding cosine similarity to a kept question reaches this value (0 disables)")
+    parser.add_argument("--dedup-threshold", type=float, default=0.0,
+                        help="Skip questions whose estimated word-shingle Jaccard similarity to an earlier question reaches this value (0 disables)")
+    parser.add_argument("--merge-duplicates", action="store_true",
+                        help="Record skipped near-duplicates under metadata.paraphrases of the question they match")
+    parser.add_argument("--cache", choices=CACHE_MODES,
+                        help="Response cache: 'on' records and reuses completions, 'replay' serves recorded ones only (default: SIM_LLM_CACHE or off)")
+    parser.add_argument("--write-batch-size", type=int, default=100,
+                        help="Answers buffered before they are flushed to MongoDB in one bulk write")
+    parser.add_argument("--write-interval", type=float, default=2.0,
+                        help="Seconds between flushes of buffered answers")
+
+def main():
+    args = parse_args()
+    print("Welcome to the Simulation Question and Response Generator!")
+    collection = connect_to_mongodb()
+
+    if args.resume:
+        run = load_run(collection, args.resume)
+        print(f"Resuming run {run['_id']}: {run['completed_iterations']} of {run['iterations']} question sets generated")
+    else:
+        scenario = args.scenario or input("Enter the scenario you want to explore: ")
+        num_iterations = args.iterations or int(input("How many sets of 10 questions do you want to generate? "))
+        if args.clear:
+            clear_collection(collection)
+        run = create_run(collection, scenario, num_iterations)
+
+    ensure_indexes(collection)
+    all_questions = simulate(collection, run, args)
 
     print(f"Total questions processed: {len(all_questions)}")
-    print("Simulation complete.")
+    print(f"Simulation complete. Run id: {run['_id']}")
 
 if __name__ == "__main__":
     main()